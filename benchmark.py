@@ -0,0 +1,270 @@
+"""スコアラーと最適化エンジンのベンチマーク。
+
+シードを固定した合成セレクション (5 / 10 / 20 / 全施設) を、混雑日・雨天・祝日の環境で
+各最適化モードに解かせ、評価回数/秒・実時間・メモリピーク・解の質 (総待ち時間、終了時刻、
+門限超過分数、超過ペナルティ込みスコア) を JSON に保存する。保存済みの結果をベースラインとして比較すると回帰を検出できる。
+
+    python benchmark.py -o bench.json                       # 計測して保存
+    python benchmark.py -o new.json --compare bench.json    # ベースラインと比較 (回帰があれば終了コード1)
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date
+
+import numpy as np
+
+SIZES = (5, 10, 20, None)  # None は ENT を除く全施設
+ENVIRONMENTS = {
+    "crowded": (date(2026, 10, 17), 10, False),   # 土曜・晴れ
+    "rainy": (date(2026, 10, 19), 80, False),     # 平日・雨
+    "holiday": (date(2026, 10, 19), 30, True),    # 平日・祝日
+}
+MODES = ("anneal", "anneal_timed", "anneal_parallel", "replica", "exact")
+START_TIME = 8 * 60 + 30
+TIMED_BUDGET_MS = 100
+MIN_WALL_MS = 5.0  # これより短いケースは実時間の回帰判定に使わない
+
+
+def load_engine(path=None):
+    # map-route.py はハイフン入りでそのまま import できないのでパスから読み込む
+    path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "map-route.py")
+    spec = importlib.util.spec_from_file_location("map_route", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["map_route"] = module  # プロセスプールのワーカーが関数を解決できるように登録
+    spec.loader.exec_module(module)
+    return module
+
+
+def case_sizes(engine):
+    return [size or len(engine.CATALOG) - 1 for size in SIZES]
+
+
+def make_cases(engine, seed):
+    """(環境名, 施設数, 選択ID配列, DPA ID配列) の一覧。同じ seed なら常に同じ組み合わせになる"""
+    rng = np.random.default_rng(seed)
+    all_ids = np.arange(1, len(engine.CATALOG))
+    cases = []
+    for env_name in ENVIRONMENTS:
+        for size in case_sizes(engine):
+            selected = np.sort(rng.choice(all_ids, size=size, replace=False))
+            # DPA対象のうち半分程度を DPA 利用にする
+            dpa = selected[engine.CATALOG.dpa[selected] & (rng.random(size) < 0.5)]
+            cases.append((env_name, size, engine._route_array(selected), engine._route_array(dpa)))
+    return cases
+
+
+def _counting_evaluator(engine):
+    class CountingEvaluator(engine.RouteEvaluator):
+        # 全体/部分ルートの採点と DP の1遷移をそれぞれ1回の評価として数える。
+        # 門限超過で途中打ち切りになった呼び出しは安いので、評価回数/秒を水増ししないよう別に数える
+        calls = 0
+        early_exits = 0
+
+        def score_from(self, route, k, state):
+            result = super().score_from(route, k, state)
+            if result[0] == engine.INF:
+                CountingEvaluator.early_exits += 1
+            else:
+                CountingEvaluator.calls += 1
+            return result
+
+        def step(self, t, prev, rested, a):
+            result = super().step(t, prev, rested, a)
+            if result is None:
+                CountingEvaluator.early_exits += 1
+            else:
+                CountingEvaluator.calls += 1
+            return result
+
+    return CountingEvaluator
+
+
+def run_mode(engine, core, mode, selected, dpa, seed):
+    """1ケースを解いて (ルート, プール内で数えた評価回数 or None) を返す。
+
+    並列チェーンは門限超過もペナルティで最後まで採点するので、反復数がそのまま完全な評価の回数になる。
+    """
+    if mode == "anneal":
+        return core.anneal(selected, dpa, True, START_TIME, seed=seed), None
+    if mode == "anneal_timed":
+        return core.anneal_timed(selected, dpa, True, START_TIME, TIMED_BUDGET_MS, seed=seed), None
+    if mode == "exact":
+        return core.solve_exact(selected, dpa, True, START_TIME), None
+    kind = "replica" if mode == "replica" else "independent"
+    route, stats = core.anneal_parallel(selected, dpa, True, START_TIME, seed=seed, mode=kind)
+    return route, sum(chain['iterations'] for chain in stats)
+
+
+def bench_optimizers(engine, cases, modes, repeat, seed):
+    counting = _counting_evaluator(engine)
+    original = engine.RouteEvaluator
+    results = []
+    for env_name, size, selected, dpa in cases:
+        core = engine.OptimizationCore(engine.EnvironmentAI(*ENVIRONMENTS[env_name]))
+        for mode in modes:
+            if mode == "exact" and size > engine.EXACT_SOLVER_MAX_ATTRS:
+                continue
+            walls, evals, exits = [], [], []
+            # プールを使うモードはワーカーへ差し替えが伝わらないので、チェーンの反復数で数える
+            if mode not in ("anneal_parallel", "replica"):
+                engine.RouteEvaluator = counting
+            try:
+                for rep in range(repeat):
+                    counting.calls = counting.early_exits = 0
+                    t0 = time.perf_counter()
+                    route, pool_evals = run_mode(engine, core, mode, selected, dpa, seed + rep)
+                    walls.append(time.perf_counter() - t0)
+                    evals.append(pool_evals if pool_evals is not None else counting.calls)
+                    exits.append(0 if pool_evals is not None else counting.early_exits)
+                # メモリピークは計測オーバーヘッドを避けるため別に1回だけ測る (プールのワーカー分は含まない)
+                tracemalloc.start()
+                run_mode(engine, core, mode, selected, dpa, seed)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            finally:
+                engine.RouteEvaluator = original
+
+            total_wait, end_time, _ = core.calc_route_cost(route, START_TIME, dpa, True)
+            infeasible = total_wait == engine.INF
+            # 門限オーバーのケースも超過ペナルティ込みのスコアで比べられるようにする
+            penalized, _ = engine.RouteEvaluator(core, dpa, True, START_TIME,
+                                                 overtime_penalty=engine.TIMED_OVERTIME_PENALTY).score(engine._id_list(route))
+            wall = statistics.median(walls)
+            results.append({
+                "mode": mode, "env": env_name, "size": size,
+                "wall_ms": round(wall * 1000, 3),
+                "evals": int(statistics.median(evals)),
+                "evals_per_sec": round(statistics.median(evals) / wall, 1) if wall > 0 else None,
+                "early_exits": int(statistics.median(exits)),
+                "peak_kib": round(peak / 1024, 1),
+                "total_wait": None if infeasible else int(total_wait),
+                "end_time": int(end_time),
+                "overtime": max(int(end_time) - engine.PARK_CLOSING_MINUTES, 0),
+                "penalized_score": int(penalized),
+                "infeasible": bool(infeasible),
+            })
+            print(f"{mode:16s} {env_name:8s} n={size:2d}  {results[-1]['wall_ms']:9.2f} ms  "
+                  f"{results[-1]['evals_per_sec'] or 0:12.0f} eval/s  wait={results[-1]['total_wait']}  over={results[-1]['overtime']}", file=sys.stderr)
+    return results
+
+
+def bench_scorers(engine, seed, repeat, n_routes=2000):
+    """同じ候補ルート集合を各スコアラーで採点した時の評価回数/秒 (ばらつきを抑えるため最速の回を採用)。
+
+    ランダムな並びはほとんど門限に間に合わないので、RouteEvaluator / BatchRouteEvaluator は超過ペナルティ付きで
+    毎回 n 施設を最後まで採点する。calc_route_cost は門限を越えた施設で打ち切るので、実際に計算した施設数を
+    steps として数え、施設1つあたりの速度 (steps_per_sec) で比べる。
+    """
+    rng = np.random.default_rng(seed)
+    core = engine.OptimizationCore(engine.EnvironmentAI(*ENVIRONMENTS["crowded"]))
+    results = []
+    for size in case_sizes(engine):
+        ids = rng.choice(np.arange(1, len(engine.CATALOG)), size=size, replace=False)
+        routes = np.array([rng.permutation(ids) for _ in range(n_routes)], dtype=engine.ROUTE_DTYPE)
+        penalty = engine.TIMED_OVERTIME_PENALTY
+        evaluator = engine.RouteEvaluator(core, [], True, START_TIME, overtime_penalty=penalty)
+        batch = engine.BatchRouteEvaluator(core, [], True, START_TIME, overtime_penalty=penalty)
+        route_lists = routes.tolist()
+        scorers = {
+            "calc_route_cost": lambda: [core.calc_route_cost(r, START_TIME, [], True) for r in routes],
+            "RouteEvaluator.score": lambda: [evaluator.score(r) for r in route_lists],
+            "BatchRouteEvaluator.score": lambda: batch.score(routes),
+        }
+        # calc_route_cost は門限を越えた施設まで (越えた施設を含む) を計算する
+        costs = scorers["calc_route_cost"]()
+        cut_steps = sum(sum(1 for item in timeline if item['type'] == "Ride") + (total == engine.INF)
+                        for total, _, timeline in costs)
+        for name, fn in scorers.items():
+            steps = cut_steps if name == "calc_route_cost" else n_routes * size
+            fn()  # ウォームアップ
+            walls = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                fn()
+                walls.append(time.perf_counter() - t0)
+            wall = min(walls)
+            results.append({"scorer": name, "size": size, "routes": n_routes, "steps": steps,
+                            "wall_ms": round(wall * 1000, 3), "evals_per_sec": round(n_routes / wall, 1),
+                            "steps_per_sec": round(steps / wall, 1)})
+    return results
+
+
+def compare(current, baseline, tolerance):
+    """ベースラインより遅くなった / 解が悪くなったケースを文字列のリストで返す"""
+    regressions = []
+    base_opt = {(r['mode'], r['env'], r['size']): r for r in baseline.get("optimizers", [])}
+    for r in current["optimizers"]:
+        b = base_opt.get((r['mode'], r['env'], r['size']))
+        if b is None:
+            continue
+        label = f"{r['mode']} {r['env']} n={r['size']}"
+        # anneal_timed は制限時間で止まるので実時間は比べない。ごく短いケースは揺らぎが大きいので除外
+        if r['mode'] != "anneal_timed" and r['wall_ms'] > MIN_WALL_MS and r['wall_ms'] > b['wall_ms'] * (1 + tolerance):
+            regressions.append(f"{label}: wall {b['wall_ms']} -> {r['wall_ms']} ms")
+        if r['infeasible'] and not b['infeasible']:
+            regressions.append(f"{label}: became infeasible")
+        elif r['total_wait'] is not None and b['total_wait'] is not None:
+            if r['total_wait'] > b['total_wait'] * (1 + tolerance):
+                regressions.append(f"{label}: total_wait {b['total_wait']} -> {r['total_wait']}")
+        elif 'penalized_score' in b and r['penalized_score'] > b['penalized_score'] * (1 + tolerance):
+            # どちらも門限オーバーなら、超過分数を含めたスコアで悪化を検出する
+            regressions.append(f"{label}: penalized_score {b['penalized_score']} (overtime {b['overtime']}) -> "
+                               f"{r['penalized_score']} (overtime {r['overtime']})")
+    base_sc = {(r['scorer'], r['size']): r for r in baseline.get("scorers", [])}
+    for r in current["scorers"]:
+        b = base_sc.get((r['scorer'], r['size']))
+        # 打ち切りの多さで評価回数/秒が変わらないよう、施設1つあたりの速度で比べる (古いベースラインは評価回数/秒)
+        metric, unit = ("steps_per_sec", "step/s") if b and "steps_per_sec" in b else ("evals_per_sec", "eval/s")
+        if b and r[metric] < b[metric] / (1 + tolerance):
+            regressions.append(f"{r['scorer']} n={r['size']}: {b[metric]} -> {r[metric]} {unit}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="スコアラーと最適化エンジンのベンチマーク")
+    parser.add_argument("-o", "--output", help="結果を保存する JSON ファイル")
+    parser.add_argument("--compare", help="比較するベースライン JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="回帰とみなす悪化率 (既定 0.25 = 25%%)")
+    parser.add_argument("--repeat", type=int, default=3, help="各ケースの繰り返し回数 (中央値を採用)")
+    parser.add_argument("--seed", type=int, default=20261017)
+    parser.add_argument("--modes", default=",".join(MODES), help="計測するモード (カンマ区切り)")
+    parser.add_argument("--engine", help="map-route.py のパス")
+    args = parser.parse_args(argv)
+
+    engine = load_engine(args.engine)
+    modes = [m for m in args.modes.split(",") if m]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(sorted(unknown))}")
+
+    result = {
+        "meta": {"seed": args.seed, "repeat": args.repeat, "python": platform.python_version(),
+                 "numpy": np.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                 "timed_budget_ms": TIMED_BUDGET_MS},
+        "scorers": bench_scorers(engine, args.seed, args.repeat),
+        "optimizers": bench_optimizers(engine, make_cases(engine, args.seed), modes, args.repeat, args.seed),
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("no regressions", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -1,10 +1,18 @@
 import streamlit as st
-import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
-import plotly.express as px
 import random
 import math
+import functools
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import contextlib
+import copy
+import hashlib
+import concurrent.futures
 from datetime import datetime, timedelta, date
 
 # ==========================================
@@ -24,20 +32,20 @@ AREA_INFO = {
 
 # FSは「DPA」または「通常待ち」のみに変更。SPは廃止。
 MASTER_DB = {
-    "ソアリン：ファンタスティック・フライト": {"area": "MH", "pos": (12, 12), "dur": 20, "type": "Ride", "indoor": True, "dpa": True},
+    "ソアリン：ファンタスティック・フライト": {"area": "MH", "pos": (12, 12), "dur": 20, "type": "Ride", "indoor": True, "dpa": True, "price": 2000},
     "ヴェネツィアン・ゴンドラ": {"area": "MH", "pos": (5, 6), "dur": 15, "type": "Ride", "indoor": False, "dpa": False},
     "トランジットスチーマーライン(MH)": {"area": "MH", "pos": (8, 15), "dur": 15, "type": "Ride", "indoor": False, "dpa": False},
     "フォートレス・エクスプロレーション": {"area": "MH", "pos": (10, 25), "dur": 30, "type": "Walk", "indoor": False, "dpa": False},
-    "トイ・ストーリー・マニア！": {"area": "AW", "pos": (5, 28), "dur": 15, "type": "Ride", "indoor": True, "dpa": True},
-    "タワー・オブ・テラー": {"area": "AW", "pos": (15, 22), "dur": 15, "type": "Ride", "indoor": True, "dpa": True},
+    "トイ・ストーリー・マニア！": {"area": "AW", "pos": (5, 28), "dur": 15, "type": "Ride", "indoor": True, "dpa": True, "price": 2000},
+    "タワー・オブ・テラー": {"area": "AW", "pos": (15, 22), "dur": 15, "type": "Ride", "indoor": True, "dpa": True, "price": 1500},
     "タートル・トーク": {"area": "AW", "pos": (18, 25), "dur": 30, "type": "Show", "indoor": True, "dpa": False},
     "エレクトリックレールウェイ(AW)": {"area": "AW", "pos": (12, 28), "dur": 10, "type": "Ride", "indoor": False, "dpa": False},
     "ビッグシティ・ヴィークル": {"area": "AW", "pos": (10, 20), "dur": 10, "type": "Ride", "indoor": False, "dpa": False},
     "ヴィレッジ・グリーティングプレイス": {"area": "AW", "pos": (2, 35), "dur": 15, "type": "Greet", "indoor": True, "dpa": False},
-    "センター・オブ・ジ・アース": {"area": "MI", "pos": (8, 42), "dur": 15, "type": "Ride", "indoor": False, "dpa": True},
+    "センター・オブ・ジ・アース": {"area": "MI", "pos": (8, 42), "dur": 15, "type": "Ride", "indoor": False, "dpa": True, "price": 1500},
     "海底2万マイル": {"area": "MI", "pos": (10, 38), "dur": 15, "type": "Ride", "indoor": True, "dpa": False},
-    "インディ・ジョーンズ・アドベンチャー": {"area": "LR", "pos": (-25, 68), "dur": 20, "type": "Ride", "indoor": True, "dpa": True},
-    "レイジングスピリッツ": {"area": "LR", "pos": (-22, 72), "dur": 12, "type": "Ride", "indoor": False, "dpa": True},
+    "インディ・ジョーンズ・アドベンチャー": {"area": "LR", "pos": (-25, 68), "dur": 20, "type": "Ride", "indoor": True, "dpa": True, "price": 1500},
+    "レイジングスピリッツ": {"area": "LR", "pos": (-22, 72), "dur": 12, "type": "Ride", "indoor": False, "dpa": True, "price": 1500},
     "トランジットスチーマーライン(LR)": {"area": "LR", "pos": (-20, 65), "dur": 15, "type": "Ride", "indoor": False, "dpa": False},
     "ミッキー＆フレンズ・グリーティングトレイル": {"area": "LR", "pos": (-28, 75), "dur": 15, "type": "Greet", "indoor": False, "dpa": False},
     "ニモ＆フレンズ・シーライダー": {"area": "PD", "pos": (-12, 48), "dur": 15, "type": "Ride", "indoor": True, "dpa": False},
@@ -53,76 +61,599 @@ MASTER_DB = {
     "ブローフィッシュ・バルーンレース": {"area": "ML", "pos": (36, 60), "dur": 5, "type": "Ride", "indoor": True, "dpa": False},
     "ワールプール": {"area": "ML", "pos": (38, 62), "dur": 5, "type": "Ride", "indoor": True, "dpa": False},
     "アリエルのプレイグラウンド": {"area": "ML", "pos": (34, 65), "dur": 20, "type": "Walk", "indoor": True, "dpa": False},
-    "アナとエルサのフローズンジャーニー": {"area": "FS", "pos": (52, 120), "dur": 20, "type": "Ride", "indoor": True, "dpa": True},
-    "ラプンツェルのランタンフェスティバル": {"area": "FS", "pos": (56, 122), "dur": 10, "type": "Ride", "indoor": False, "dpa": True},
-    "ピーターパンのネバーランドアドベンチャー": {"area": "FS", "pos": (62, 125), "dur": 20, "type": "Ride", "indoor": True, "dpa": True},
+    "アナとエルサのフローズンジャーニー": {"area": "FS", "pos": (52, 120), "dur": 20, "type": "Ride", "indoor": True, "dpa": True, "price": 2500},
+    "ラプンツェルのランタンフェスティバル": {"area": "FS", "pos": (56, 122), "dur": 10, "type": "Ride", "indoor": False, "dpa": True, "price": 2000},
+    "ピーターパンのネバーランドアドベンチャー": {"area": "FS", "pos": (62, 125), "dur": 20, "type": "Ride", "indoor": True, "dpa": True, "price": 2500},
     "フェアリー・ティンカーベルのビジーバギー": {"area": "FS", "pos": (60, 121), "dur": 10, "type": "Ride", "indoor": False, "dpa": False}, 
 }
 
 PARK_CLOSING_MINUTES = 22 * 60  # 22時門限 (1320分)
 
+# ==========================================
+# 1.5 施設カタログ (ID 0 = エントランス, 1.. = MASTER_DB の登録順)
+# ==========================================
+class AttractionCatalog:
+    """MASTER_DB を施設IDで引ける NumPy 配列 (Struct of Arrays) にまとめたもの。
+
+    最適化エンジンはルートを int16 の施設ID配列で扱い、施設名は UI 側でだけ使う。
+    """
+    def __init__(self, master_db, area_info):
+        self.names = ["エントランス"] + list(master_db)
+        self.name_to_id = {name: i for i, name in enumerate(master_db, start=1)}
+        self.area_codes = list(area_info)
+        records = [{"area": "ENT", "pos": (0, 0), "dur": 0, "indoor": False, "dpa": False}] + list(master_db.values())
+        self.pos = np.array([r['pos'] for r in records], dtype=np.float64)
+        self.dur = np.array([r['dur'] for r in records], dtype=np.int16)
+        self.area = np.array([self.area_codes.index(r['area']) for r in records], dtype=np.int8)
+        self.indoor = np.array([r['indoor'] for r in records], dtype=bool)
+        self.dpa = np.array([r.get('dpa', False) for r in records], dtype=bool)
+        # DPA の1回あたりの価格 (円、目安。実際の価格は日や時期で変わる)。DPA 対象外は 0
+        self.price = np.array([r.get('price', 0) for r in records], dtype=np.int64)
+        # FSは100分、DPA対象は80分、その他は30分が待ち時間の基準
+        self.wait_base = np.where(self.area == self.area_codes.index("FS"), 100.0, np.where(self.dpa, 80.0, 30.0))
+        self.wait_base[ENT_ID] = 0.0
+
+    def __len__(self):
+        return len(self.names)
+
+    def encode(self, names):
+        return np.array([self.name_to_id[name] for name in names], dtype=ROUTE_DTYPE)
+
+    def decode(self, route):
+        return [self.names[a] for a in route]
+
+    def area_code(self, attr_id):
+        return self.area_codes[self.area[attr_id]]
+
+ENT_ID = 0
+ROUTE_DTYPE = np.int16
+CATALOG = AttractionCatalog(MASTER_DB, AREA_INFO)
+
+def _route_array(ids):
+    return np.asarray(ids, dtype=ROUTE_DTYPE)
+
+def _id_list(ids):
+    # スカラー計算のホットパス用に Python の int リストへ変換する
+    return np.asarray(ids, dtype=ROUTE_DTYPE).tolist()
+
+# ==========================================
+# 1.6 移動時間マトリクス
+# ==========================================
+FS_TRAVEL_SEED = 0  # FSエリア内移動(3〜5分)の乱数シード
+
+@functools.lru_cache(maxsize=8)
+def build_travel_matrix(fs_seed=FS_TRAVEL_SEED):
+    """全施設間の移動時間(分)を一度だけ計算する。travel[from_id, to_id]"""
+    n = len(CATALOG)
+    is_fs = CATALOG.area == CATALOG.area_codes.index("FS")
+    is_ent = CATALOG.area == CATALOG.area_codes.index("ENT")
+    from_fs, to_fs = is_fs[:, None], is_fs[None, :]
+    
+    # FS内の移動時間は区間ごとに1回だけ引き、往復で同じ値にする
+    rng = random.Random(fs_seed)
+    fs_minutes = np.zeros((n, n))
+    for i in range(n):
+        for j in range(i + 1, n):
+            fs_minutes[i, j] = fs_minutes[j, i] = rng.randint(3, 5)
+    
+    delta = CATALOG.pos[:, None, :] - CATALOG.pos[None, :, :]
+    time_cost = np.sqrt(delta[..., 0]**2 + delta[..., 1]**2) * 0.8
+    # 別エリアへの移動は1.5倍 (エントランスからは除く)
+    cross_area = ~is_ent[:, None] & (CATALOG.area[:, None] != CATALOG.area[None, :])
+    time_cost = np.where(cross_area, time_cost * 1.5, time_cost)
+    time_cost = np.where(from_fs | to_fs, 20, time_cost)                  # 他エリアとの行き来も遠い
+    time_cost = np.where(is_ent[:, None] & to_fs, 25, time_cost)           # エントランスからFSは非常に遠い
+    time_cost = np.where(from_fs & to_fs, fs_minutes, time_cost)          # FSエリア内移動は一瞬
+    
+    # 2分未満の移動はタイムラインに記録せず、時間も加算しない
+    travel = np.where(time_cost >= 2, time_cost.astype(np.int32), 0).astype(np.int32)
+    np.fill_diagonal(travel, 0)
+    travel.flags.writeable = False
+    return travel
+
 # ==========================================
 # 2. 環境シミュレーション・エンジン
 # ==========================================
+WAIT_TABLE_START = 8 * 60  # 待ち時間テーブルの範囲 (8:00〜22:00)
+WAIT_TABLE_END = PARK_CLOSING_MINUTES
+
+@functools.lru_cache(maxsize=32)
+def build_wait_table(date_class, rain_bucket, is_holiday):
+    """(施設ID x 分) の待ち時間を一括計算する。table[attr_id, minute - WAIT_TABLE_START]"""
+    minutes = np.arange(WAIT_TABLE_START, WAIT_TABLE_END + 1)
+    time_factor = np.sin(np.pi * np.maximum(0, minutes - 480) / 840)
+    if rain_bucket == "rain":
+        weather_mod = np.where(CATALOG.indoor, 1.3, 0.7)
+    else:
+        weather_mod = np.ones(len(CATALOG))
+    crowd_mod = 1.5 if date_class == "weekend" or is_holiday else 1.0
+
+    wait = (CATALOG.wait_base[:, None] * (1 + 0.6 * time_factor)[None, :] * weather_mod[:, None] * crowd_mod).astype(np.int32)
+    table = np.maximum(5, wait)
+    table.flags.writeable = False
+    return table
+
+@functools.lru_cache(maxsize=32)
+def _wait_table_rows(date_class, rain_bucket, is_holiday):
+    # スカラー参照用 (list の添字アクセスは ndarray より速い)
+    return build_wait_table(date_class, rain_bucket, is_holiday).tolist()
+
 class EnvironmentAI:
     def __init__(self, selected_date, rain_prob, is_extra_holiday):
         self.selected_date = selected_date
         self.rain_prob = rain_prob
+        self.is_extra_holiday = is_extra_holiday
         self.is_crowded = selected_date.weekday() >= 5 or is_extra_holiday
+        # 同じ (曜日区分, 雨区分, 祝日) の組み合わせはテーブルを共有する
+        self.table_key = ("weekend" if selected_date.weekday() >= 5 else "weekday",
+                          "rain" if rain_prob > 50 else "dry",
+                          bool(is_extra_holiday))
+        self.wait_table = build_wait_table(*self.table_key)
+        self.wait_rows = _wait_table_rows(*self.table_key)
+        # 「到着時刻 + 待ち時間」が時刻に対して単調か (後から並んだ人が先に乗れない)
+        self.is_fifo = bool(np.all(np.diff(self.wait_table, axis=1) >= -1))
+
+    @property
+    def args(self):
+        # ワーカープロセスで同じ環境を組み立て直すための引数
+        return (self.selected_date, self.rain_prob, self.is_extra_holiday)
 
-    def get_wait_curve(self, attr_name, current_min):
-        attr = MASTER_DB[attr_name]
+    def with_observed_waits(self, observed_waits, now):
+        """観測した待ち時間 ({施設ID: 分}) に合わせ、その施設の now 以降のカーブを倍率補正した環境を返す。
+
+        共有キャッシュのテーブルは書き換えずにコピーする。args は補正前のままなので、
+        補正済みの環境はワーカープロセスでは組み立て直せない (プロセス内のソルバーで使う)。
+        """
+        env = copy.copy(self)
+        table = np.array(self.wait_table)
+        col = min(max(0, now - WAIT_TABLE_START), WAIT_TABLE_END - WAIT_TABLE_START)
+        for attr_id, minutes in observed_waits.items():
+            scale = minutes / table[attr_id, col]
+            table[attr_id, col:] = np.maximum(0, np.rint(table[attr_id, col:] * scale))
+        table.flags.writeable = False
+        env.wait_table = table
+        env.wait_rows = table.tolist()
+        env.is_fifo = bool(np.all(np.diff(table, axis=1) >= -1))
+        return env
+
+    def get_wait_curve(self, attr_id, current_min):
+        if current_min <= WAIT_TABLE_END:
+            # 開園前はテーブル先頭 (8:00) と同じ値になる
+            return self.wait_rows[attr_id][max(0, int(current_min) - WAIT_TABLE_START)]
+
+        # 22時以降はテーブル範囲外なので従来の式で算出
         # FSエリアは「通常待ち」も可能という想定（マジックパス相当や解放時を考慮）
         # DPAでなければ長めの待ち時間を設定
-        base = 100 if attr['area'] == "FS" else (80 if attr.get('dpa') else 30)
+        base = CATALOG.wait_base[attr_id]
         
         # 開園〜22時での山なり混雑ピーク
         time_factor = np.sin(np.pi * max(0, (current_min - 480)) / 840)
-        weather_mod = 1.3 if self.rain_prob > 50 and attr['indoor'] else 0.7 if self.rain_prob > 50 else 1.0
+        weather_mod = 1.3 if self.rain_prob > 50 and CATALOG.indoor[attr_id] else 0.7 if self.rain_prob > 50 else 1.0
         crowd_mod = 1.5 if self.is_crowded else 1.0
         
         wait = int(base * (1 + 0.6 * time_factor) * weather_mod * crowd_mod)
         return max(5, wait)
 
+# ------------------------------------------
+# 待ち時間のばらつき (モンテカルロ用シナリオ)
+# ------------------------------------------
+RISK_SCENARIOS = 1000
+RISK_SEARCH_SCENARIOS = 200  # 最適化中の近傍比較はシナリオの先頭この数だけで行う
+RISK_SEED = 0
+RISK_QUANTILE = 0.9
+RISK_CROWD_SIGMA = 0.15  # その日の混雑度のブレ (対数正規の σ)
+RISK_PEAK_SIGMA = 0.3    # 昼のピークの高さのブレ
+RISK_ATTR_SIGMA = 0.25   # 施設ごとのブレ (運営状況・一時休止など)
+
+# 時間帯係数 sin(π (分 - 480) / 840) を0時から翌日0時過ぎまで引けるように持っておく (sin を毎回計算しない)
+# (build_wait_table と同じ float64 の式なので、ばらつき無しなら同じ値になる)
+_TIME_FACTOR = np.sin(np.pi * np.maximum(0, np.arange(2 * 24 * 60) - 480) / 840)
+
+def _lognormal_mean_one(rng, sigma, size):
+    # 平均が 1 になるよう μ = -σ²/2 にした対数正規乱数
+    return rng.lognormal(-sigma**2 / 2, sigma, size)
+
+class WaitScenarios:
+    """get_wait_curve と同じ式の各係数 (混雑度・天気・時間帯のピーク) に乱数を掛けた S 通りの待ち時間シナリオ。
+
+    (S, 施設数) の係数だけを持ち、(S, 施設数, 分) のテーブルは作らない。待ち時間は参照時に計算する。
+    計算は float64 で build_wait_table と同じ順 (基本待ち x 時間帯 x 天気 x 混雑度) に掛け、乱数の係数は最後に掛ける。
+    雨は降水確率どおりにシナリオごとに降る/降らないを引く。ただし σ がすべて 0 (ばらつき無し) のときは
+    get_wait_curve と同じく「降水確率 50% 超なら雨」とし、全シナリオが calc_route_cost と一致するようにする。
+    """
+    def __init__(self, env, n_scenarios=RISK_SCENARIOS, seed=RISK_SEED):
+        rng = np.random.default_rng(seed)
+        n_attr = len(CATALOG)
+        self.n_scenarios = n_scenarios
+        crowd = (1.5 if env.is_crowded else 1.0) * _lognormal_mean_one(rng, RISK_CROWD_SIGMA, n_scenarios)
+        rain = rng.random(n_scenarios) < env.rain_prob / 100
+        if RISK_CROWD_SIGMA == RISK_PEAK_SIGMA == RISK_ATTR_SIGMA == 0:
+            rain[:] = env.rain_prob > 50
+        weather = np.where(rain[:, None], np.where(CATALOG.indoor, 1.3, 0.7)[None, :], 1.0)
+        self.amplitude = 0.6 * _lognormal_mean_one(rng, RISK_PEAK_SIGMA, n_scenarios)
+        # 施設 a・シナリオ s の係数を施設ごとに連続した配列で持つ。天気と (混雑度 x 施設ごとのブレ) は分けておき、
+        # ばらつき無しのとき丸め誤差まで build_wait_table と一致させる
+        self.weather = np.ascontiguousarray(weather.T)
+        self.attr_scale = np.ascontiguousarray(
+            (crowd[:, None] * _lognormal_mean_one(rng, RISK_ATTR_SIGMA, (n_scenarios, n_attr))).T)
+
+    def head(self, n):
+        """先頭 n シナリオだけのビュー (探索中の安い比較用)"""
+        sub = copy.copy(self)
+        sub.n_scenarios = min(n, self.n_scenarios)
+        sub.amplitude = self.amplitude[:sub.n_scenarios]
+        sub.weather = self.weather[:, :sub.n_scenarios]
+        sub.attr_scale = self.attr_scale[:, :sub.n_scenarios]
+        return sub
+
+    def waits(self, attr_ids, minutes):
+        """attr_ids: (K,) の施設ID、minutes: (K, S) の到着時刻 -> (K, S) の待ち時間 (分)"""
+        time_factor = _TIME_FACTOR[np.minimum(minutes, len(_TIME_FACTOR) - 1)]
+        # (K, S) の一時配列を増やさないよう、同じ配列に順に掛けていく
+        wait = self.amplitude * time_factor
+        wait += 1
+        wait *= CATALOG.wait_base[attr_ids][:, None]
+        wait *= self.weather[attr_ids]
+        wait *= self.attr_scale[attr_ids]
+        return np.maximum(5, wait.astype(np.int64))
+
+# ==========================================
+# 2.5 計測 (最適化の診断情報)
+# ==========================================
+class PlanStats:
+    """1回のプラン作成の計測値。カウンタ・タイマー・収束トレース (反復ごとの現在解/最良解) を持つ。
+
+    各メソッドに stats=None (既定) を渡した場合は計測しないので、オフ時のコストは None 判定だけ。
+    """
+    def __init__(self, trace_every=10):
+        self.trace_every = trace_every
+        self.info = {}
+        self.counters = {}
+        self.timers = {}  # name -> [呼び出し回数, 合計秒]
+        self.trace = []   # (反復, 現在解, 最良解)
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds, calls=1):
+        timer = self.timers.setdefault(name, [0, 0.0])
+        timer[0] += calls
+        timer[1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def record(self, iteration, current, best):
+        self.trace.append((iteration, current, best))
+
+    def merge(self, counters, timers):
+        """ワーカープロセスで計測したカウンタ・タイマー (counters / timers 属性の中身) を足し込む"""
+        for name, n in counters.items():
+            self.incr(name, n)
+        for name, (calls, seconds) in timers.items():
+            self.add_time(name, seconds, calls)
+
+    def to_dict(self):
+        # inf は JSON にできないので None にする
+        finite = lambda v: None if v == INF else v
+        counters = dict(self.counters)
+        if counters.get('iterations'):
+            counters['acceptance_rate'] = counters.get('accepted', 0) / counters['iterations']
+        return {"info": self.info, "counters": counters,
+                "timers": {name: {"calls": c, "seconds": sec} for name, (c, sec) in self.timers.items()},
+                "trace": [[i, finite(cur), finite(best)] for i, cur, best in self.trace]}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    def to_prometheus(self, prefix="magic_router"):
+        """Prometheus のテキスト形式 (solver ラベル付き) で書き出す"""
+        labels = f'{{solver="{self.info.get("solver", "unknown")}"}}'
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total{labels} {value}"]
+        for name, (calls, seconds) in sorted(self.timers.items()):
+            lines += [f"# TYPE {prefix}_{name}_seconds_total counter", f"{prefix}_{name}_seconds_total{labels} {seconds:.6f}",
+                      f"# TYPE {prefix}_{name}_calls_total counter", f"{prefix}_{name}_calls_total{labels} {calls}"]
+        if self.trace and self.trace[-1][2] != INF:
+            lines += [f"# TYPE {prefix}_best_score gauge", f"{prefix}_best_score{labels} {self.trace[-1][2]}"]
+        return "\n".join(lines) + "\n"
+
 # ==========================================
 # 3. 最適化エンジン (厳格な時間管理・距離モデル)
 # ==========================================
+DPA_WAIT_MINUTES = 10
+DPA_ENUM_MAX_ATTRS = 12  # DPA 候補がこれより多ければ単独効果の大きい順にここまで絞ってから全列挙する
+DPA_POOL_MS_PER_ATTR = 2  # optimize_dpa の候補ルート1本あたりの探索時間 (施設数 x これ ms)
+REST_MINUTES = 60
+REST_WINDOWS = ((690, 810), (1050, 1170))  # 11:30~13:30 / 17:30~19:30
+INF = float('inf')
+
+class RouteEvaluator:
+    """施設IDのルートをタイムラインを作らずに採点する軽量スコアラー。
+
+    状態は (現在時刻, 現在地ID, 休憩済みフラグ, 累積待ち時間) のタプルで、
+    途中までの状態を使い回して後半だけを再計算できる。
+    overtime_penalty を指定すると門限超過を inf にせず「待ち時間 + 超過分数 x penalty」で採点する。
+    start_id / rested で来園途中 (現在地・休憩済みか) から始められる。
+    """
+    def __init__(self, core, dpa_ids, auto_rest, start_time, overtime_penalty=None, start_id=ENT_ID, rested=False):
+        self.overtime_penalty = overtime_penalty
+        self.travel = core.travel
+        self.wait_rows = core.env.wait_rows
+        self.dur = core.dur
+        self.is_dpa = [False] * len(CATALOG)
+        for a in _id_list(dpa_ids):
+            self.is_dpa[a] = True
+        self.start_state = (start_time, start_id, rested or not auto_rest, 0)
+
+    def score(self, route):
+        return self.score_from(route, 0, self.start_state)
+
+    def score_from(self, route, k, state):
+        """route[k:] だけを state から再計算し (total_wait, end_time) を返す"""
+        t, prev, rested, total = state
+        if total == INF:
+            return INF, t
+        travel, wait_rows, is_dpa, dur, penalty = self.travel, self.wait_rows, self.is_dpa, self.dur, self.overtime_penalty
+        for idx in range(k, len(route)):
+            a = route[idx]
+            t += travel[prev][a]
+            if not rested and (REST_WINDOWS[0][0] <= t <= REST_WINDOWS[0][1] or REST_WINDOWS[1][0] <= t <= REST_WINDOWS[1][1]):
+                t += REST_MINUTES
+                rested = True
+            if t > WAIT_TABLE_END:
+                if penalty is None:
+                    return INF, t
+                wait = DPA_WAIT_MINUTES if is_dpa[a] else wait_rows[a][-1]
+            else:
+                wait = DPA_WAIT_MINUTES if is_dpa[a] else wait_rows[a][t - WAIT_TABLE_START if t > WAIT_TABLE_START else 0]
+            t += wait + dur[a]
+            if t > PARK_CLOSING_MINUTES and penalty is None:
+                return INF, t
+            total += wait
+            prev = a
+        if t > PARK_CLOSING_MINUTES:
+            return total + penalty * (t - PARK_CLOSING_MINUTES), t
+        return total, t
+
+    def state_cost(self, state):
+        """prefix_states の最終状態の採点値"""
+        t, _, _, total = state
+        if self.overtime_penalty is not None and t > PARK_CLOSING_MINUTES:
+            return total + self.overtime_penalty * (t - PARK_CLOSING_MINUTES)
+        return total
+
+    def step(self, t, prev, rested, a):
+        """prev から施設 a へ移動して体験した後の (時刻, 休憩済みフラグ, 待ち時間)。門限超過なら None"""
+        t += self.travel[prev][a]
+        if not rested and (REST_WINDOWS[0][0] <= t <= REST_WINDOWS[0][1] or REST_WINDOWS[1][0] <= t <= REST_WINDOWS[1][1]):
+            t += REST_MINUTES
+            rested = True
+        if t > WAIT_TABLE_END:
+            return None
+        wait = DPA_WAIT_MINUTES if self.is_dpa[a] else self.wait_rows[a][t - WAIT_TABLE_START if t > WAIT_TABLE_START else 0]
+        t += wait + self.dur[a]
+        if t > PARK_CLOSING_MINUTES:
+            return None
+        return t, rested, wait
+
+    def greedy_route(self, ids):
+        """毎回「体験終了が最も早くなる施設」を選ぶ貪欲法のルート (門限に間に合う初期解づくり用)"""
+        t, prev, rested, _ = self.start_state
+        remaining = list(ids)
+        route = []
+        while remaining:
+            best = None
+            for a in remaining:
+                moved = self.step(t, prev, rested, a)
+                if moved is not None and (best is None or moved[0] < best[1][0]):
+                    best = (a, moved)
+            if best is None:
+                # どれも間に合わなければ残りはそのまま後ろに付ける
+                return route + remaining
+            a, (t, rested, _) = best
+            route.append(a)
+            remaining.remove(a)
+            prev = a
+        return route
+
+    def min_wait_after(self):
+        """suffix_min[a][m] = 時刻 m 以降に施設 a に並んだ場合の最小待ち時間 (下界計算用)"""
+        table = np.asarray(self.wait_rows)
+        suffix_min = np.minimum.accumulate(table[:, ::-1], axis=1)[:, ::-1].copy()
+        suffix_min[np.asarray(self.is_dpa)] = DPA_WAIT_MINUTES
+        return suffix_min.tolist()
+
+    def prefix_states(self, route, states=None, k=0):
+        """各位置に入る直前の状態を返す (states[k] 以降を上書き)。門限超過後は累積待ちが inf になる (ペナルティ無しの場合)"""
+        if states is None:
+            states = [self.start_state]
+        del states[k + 1:]
+        t, prev, rested, total = states[k]
+        travel, wait_rows, is_dpa, dur = self.travel, self.wait_rows, self.is_dpa, self.dur
+        for idx in range(k, len(route)):
+            a = route[idx]
+            t += travel[prev][a]
+            if not rested and (REST_WINDOWS[0][0] <= t <= REST_WINDOWS[0][1] or REST_WINDOWS[1][0] <= t <= REST_WINDOWS[1][1]):
+                t += REST_MINUTES
+                rested = True
+            if t > WAIT_TABLE_END:
+                wait = DPA_WAIT_MINUTES if is_dpa[a] else wait_rows[a][-1]
+            else:
+                wait = DPA_WAIT_MINUTES if is_dpa[a] else wait_rows[a][t - WAIT_TABLE_START if t > WAIT_TABLE_START else 0]
+            t += wait + dur[a]
+            # ペナルティ無しの場合、門限超過以降の状態はすべて棄却扱い
+            total = INF if t > PARK_CLOSING_MINUTES and self.overtime_penalty is None else total + wait
+            prev = a
+            states.append((t, prev, rested, total))
+        return states
+
+class BatchRouteEvaluator:
+    """(K x N) の候補ルートをまとめて採点する NumPy 版スコアラー。
+
+    ルートの位置 (列) ごとに K 本を同時に1歩ずつ進め、移動時間と待ち時間は配列の添字参照で引く。
+    RouteEvaluator.score を K 回呼ぶのと同じ結果を返す (門限超過ルートの終了時刻だけは参考値)。
+    overtime_penalty を指定すると RouteEvaluator と同じく門限超過を「待ち時間 + 超過分数 x penalty」で採点する。
+    """
+    def __init__(self, core, dpa_ids, auto_rest, start_time, overtime_penalty=None):
+        self.overtime_penalty = overtime_penalty
+        self.travel = core.travel_matrix
+        self.wait_table = core.env.wait_table
+        self.dur = CATALOG.dur.astype(np.int64)
+        self.is_dpa = np.zeros(len(CATALOG), dtype=bool)
+        self.is_dpa[_id_list(dpa_ids)] = True
+        self.auto_rest = auto_rest
+        self.start_time = start_time
+
+    def score(self, routes, is_dpa=None):
+        """routes: (K, N) の施設ID配列。is_dpa に (K, 施設数) の配列を渡すとルートごとに DPA を変えられる。
+
+        戻り値は (total_wait: float64 (門限超過は inf、ペナルティ付きなら超過分込みの値), end_time: int64) の K 要素配列。
+        """
+        routes = np.atleast_2d(np.asarray(routes, dtype=np.intp))
+        k, n = routes.shape
+        is_dpa = self.is_dpa if is_dpa is None else np.asarray(is_dpa, dtype=bool)
+        rows = np.arange(k)
+        t = np.full(k, self.start_time, dtype=np.int64)
+        prev = np.full(k, ENT_ID, dtype=np.intp)
+        rested = np.full(k, not self.auto_rest)
+        total = np.zeros(k, dtype=np.int64)
+        feasible = np.ones(k, dtype=bool)
+        
+        for col in range(n):
+            a = routes[:, col]
+            t += self.travel[prev, a]
+            if self.auto_rest:
+                in_window = np.zeros(k, dtype=bool)
+                for lo, hi in REST_WINDOWS:
+                    in_window |= (lo <= t) & (t <= hi)
+                rest = in_window & ~rested
+                t += REST_MINUTES * rest
+                rested |= rest
+            feasible &= t <= WAIT_TABLE_END
+            minute = np.clip(t - WAIT_TABLE_START, 0, WAIT_TABLE_END - WAIT_TABLE_START)
+            dpa = is_dpa[a] if is_dpa.ndim == 1 else is_dpa[rows, a]
+            wait = np.where(dpa, DPA_WAIT_MINUTES, self.wait_table[a, minute])
+            t += wait + self.dur[a]
+            feasible &= t <= PARK_CLOSING_MINUTES
+            total += wait
+            prev = a
+        
+        if self.overtime_penalty is not None:
+            # 22時以降の待ち時間はテーブル末尾の値 (minute の clip) で数え、最後まで回した超過分数で採点する
+            return (total + self.overtime_penalty * np.maximum(t - PARK_CLOSING_MINUTES, 0)).astype(np.float64), t
+        return np.where(feasible, total, INF), t
+
+class ScenarioRouteEvaluator:
+    """(K x N) の候補ルートを S 通りの待ち時間シナリオで同時にシミュレーションする (結果は (K, S))。
+
+    門限を過ぎても打ち切らずに最後まで回し、終了時刻の分布から門限オーバーの確率を出す。
+    """
+    def __init__(self, core, scenarios, dpa_ids, auto_rest, start_time, start_id=ENT_ID, rested=False):
+        self.travel = core.travel_matrix
+        self.scenarios = scenarios
+        self.dur = CATALOG.dur.astype(np.int64)
+        self.is_dpa = np.zeros(len(CATALOG), dtype=bool)
+        self.is_dpa[_id_list(dpa_ids)] = True
+        self.auto_rest = auto_rest
+        self.start_time = start_time
+        self.start_id = start_id
+        self.rested = rested or not auto_rest
+
+    def simulate(self, routes):
+        """(total_wait, end_time) をそれぞれ (K, S) の int64 配列で返す"""
+        routes = np.atleast_2d(np.asarray(routes, dtype=np.intp))
+        k, n = routes.shape
+        shape = (k, self.scenarios.n_scenarios)
+        t = np.full(shape, self.start_time, dtype=np.int64)
+        prev = np.full(k, self.start_id, dtype=np.intp)
+        rested = np.full(shape, self.rested)
+        total = np.zeros(shape, dtype=np.int64)
+        
+        for col in range(n):
+            a = routes[:, col]
+            t += self.travel[prev, a][:, None]
+            if self.auto_rest:
+                in_window = np.zeros(shape, dtype=bool)
+                for lo, hi in REST_WINDOWS:
+                    in_window |= (lo <= t) & (t <= hi)
+                rest = in_window & ~rested
+                t += REST_MINUTES * rest
+                rested |= rest
+            wait = np.where(self.is_dpa[a][:, None], DPA_WAIT_MINUTES, self.scenarios.waits(a, t))
+            t += wait + self.dur[a][:, None]
+            total += wait
+            prev = a
+        return total, t
+
+    def objective(self, routes, quantile=RISK_QUANTILE):
+        """ルートごとの「待ち時間 + 門限超過ペナルティ」の分位点 (K,)。quantile=0.9 なら悪い方から1割の水準"""
+        total, end = self.simulate(routes)
+        cost = total + TIMED_OVERTIME_PENALTY * np.maximum(0, end - PARK_CLOSING_MINUTES)
+        return np.quantile(cost, quantile, axis=1)
+
+    def summary(self, route):
+        """1本のルートのリスク指標: 期待総待ち時間、P90 総待ち時間、P90 終了時刻、門限 (22:00) に間に合わない確率"""
+        total, end = self.simulate(route)
+        total, end = total[0], end[0]
+        return {"expected_wait": float(total.mean()), "p90_wait": float(np.quantile(total, 0.9)),
+                "p90_end": int(np.ceil(np.quantile(end, 0.9))), "miss_prob": float(np.mean(end > PARK_CLOSING_MINUTES))}
+
+def swap_neighborhood(route):
+    """route の全2点スワップ (N(N-1)/2 本) を (M, N) 配列で返す。2つ目の戻り値は入れ替えた位置 (M, 2)"""
+    route = np.asarray(route)
+    i, j = np.triu_indices(len(route), k=1)
+    neighbors = np.repeat(route[None, :], len(i), axis=0)
+    rows = np.arange(len(i))
+    neighbors[rows, i] = route[j]
+    neighbors[rows, j] = route[i]
+    return neighbors, np.stack([i, j], axis=1)
+
 class OptimizationCore:
-    def __init__(self, env):
+    def __init__(self, env, fs_seed=FS_TRAVEL_SEED):
         self.env = env
+        self.fs_seed = fs_seed
+        self.travel_matrix = build_travel_matrix(fs_seed)
+        # スカラー計算のホットパスではリストの方が速いので list 化して保持
+        self.travel = self.travel_matrix.tolist()
+        self.dur = CATALOG.dur.tolist()
+
+    def calc_route_cost(self, route, start_time, dpa_ids, auto_rest, stats=None, start_id=ENT_ID, rested=False):
+        """ルート (施設ID配列) のタイムラインを組み立てる。UI 表示用に施設名を入れて返す"""
+        if stats is not None:
+            with stats.timer("calc_route_cost"):
+                return self._calc_route_cost(route, start_time, dpa_ids, auto_rest, stats, start_id, rested)
+        return self._calc_route_cost(route, start_time, dpa_ids, auto_rest, None, start_id, rested)
 
-    def calc_route_cost(self, route, start_time, dpa_list, auto_rest):
+    def _calc_route_cost(self, route, start_time, dpa_ids, auto_rest, stats, start_id=ENT_ID, rested=False):
         current_t = start_time
-        current_pos = (0, 0)
-        current_area = "ENT"
+        current_id = start_id
         total_wait = 0
         timeline = []
-        has_rested = not auto_rest
+        has_rested = rested or not auto_rest
+        dpa_set = set(_id_list(dpa_ids))
         
-        for name in route:
-            attr = MASTER_DB[name]
+        for attr_id in _id_list(route):
+            name = CATALOG.names[attr_id]
+            area = CATALOG.area_code(attr_id)
             
-            # 1. 距離計算（FSモデルの適正化）
-            if current_area == "FS" and attr['area'] == "FS":
-                time_cost = random.randint(3, 5) # FSエリア内移動は一瞬
-            elif current_area == "ENT" and attr['area'] == "FS":
-                time_cost = 25 # エントランスからFSは非常に遠い
-            elif (current_area != "FS" and attr['area'] == "FS") or (current_area == "FS" and attr['area'] != "FS"):
-                time_cost = 20 # 他エリアとの行き来も遠い
-            else:
-                dist = math.sqrt((current_pos[0]-attr['pos'][0])**2 + (current_pos[1]-attr['pos'][1])**2)
-                time_cost = dist * 0.8
-                if current_area != "ENT" and current_area != attr['area']:
-                    time_cost *= 1.5
+            # 1. 移動時間 (事前計算済みマトリクスを参照)
+            time_cost = self.travel[current_id][attr_id]
             
             # 移動の記録
-            if time_cost >= 2:
+            if time_cost > 0:
                 timeline.append({
-                    "name": f"移動 ({AREA_INFO[current_area]['name']} → {AREA_INFO[attr['area']]['name']})", 
-                    "arrive": current_t, "start": current_t, "end": current_t + int(time_cost),
-                    "wait": 0, "dur": int(time_cost), "type": "Travel", "area": "NA"
+                    "name": f"移動 ({AREA_INFO[CATALOG.area_code(current_id)]['name']} → {AREA_INFO[area]['name']})", 
+                    "arrive": current_t, "start": current_t, "end": current_t + time_cost,
+                    "wait": 0, "dur": time_cost, "type": "Travel", "area": "NA"
                 })
-                current_t += int(time_cost)
+                current_t += time_cost
             
             # 2. 自動休憩 (11:30~13:30 または 17:30~19:30)
             if auto_rest and not has_rested:
@@ -131,17 +662,20 @@ class OptimizationCore:
                     timeline.append({
                         "name": "ダイニング休憩", 
                         "arrive": current_t, "start": current_t, "end": current_t + rest_dur,
-                        "wait": 0, "dur": rest_dur, "type": "Rest", "area": attr['area']
+                        "wait": 0, "dur": rest_dur, "type": "Rest", "area": area
                     })
                     current_t += rest_dur
                     has_rested = True
 
             # 3. 待ち時間算出 (DPA vs 通常)
-            wait = 10 if name in dpa_list else self.env.get_wait_curve(name, current_t)
+            if attr_id in dpa_set:
+                wait = DPA_WAIT_MINUTES
+            else:
+                wait = self.env.get_wait_curve(attr_id, current_t)
             
             arrive_t = int(current_t)
             start_t = arrive_t + wait
-            end_t = start_t + attr['dur']
+            end_t = start_t + self.dur[attr_id]
             
             # 22時門限を過ぎたら即座にペナルティ（ルート棄却）
             if end_t > PARK_CLOSING_MINUTES:
@@ -150,43 +684,875 @@ class OptimizationCore:
             # 4. 体験の記録
             timeline.append({
                 "name": name, "arrive": arrive_t, "start": start_t, "end": end_t, 
-                "wait": wait, "dur": attr['dur'], "type": "Ride", "area": attr['area']
+                "wait": wait, "dur": self.dur[attr_id], "type": "Ride", "area": area
             })
             
             current_t = end_t
-            current_pos = attr['pos']
-            current_area = attr['area']
+            current_id = attr_id
             total_wait += wait
 
         return total_wait, current_t, timeline
 
-    def anneal(self, selected, dpa_list, auto_rest, start_time):
-        best_route = list(selected)
-        random.shuffle(best_route)
-        best_score, best_end, _ = self.calc_route_cost(best_route, start_time, dpa_list, auto_rest)
+    def score_routes(self, routes, dpa_ids, auto_rest, start_time):
+        """(K, N) の候補ルートを一括採点し (total_wait, end_time) の配列を返す"""
+        return BatchRouteEvaluator(self, dpa_ids, auto_rest, start_time).score(routes)
+
+    def polish_swaps(self, route, dpa_ids, auto_rest, start_time, max_sweeps=50, overtime_penalty=None):
+        """全スワップ近傍を一括採点し、改善が無くなるまで最良スワップを適用する (最急降下)。
+
+        overtime_penalty を渡すと門限オーバーのルートも超過分数を減らす方向に磨ける。
+        """
+        evaluator = BatchRouteEvaluator(self, dpa_ids, auto_rest, start_time, overtime_penalty)
+        route = _route_array(route)
+        if len(route) < 2:
+            return route
+        score = evaluator.score(route)[0][0]
+        for _ in range(max_sweeps):
+            neighbors, _ = swap_neighborhood(route)
+            scores, _ = evaluator.score(neighbors)
+            best = int(np.argmin(scores))
+            if not scores[best] < score:
+                break
+            route, score = neighbors[best], scores[best]
+        return route
+
+    def plan_robust(self, selected, dpa_ids, auto_rest, start_time, scenarios=None, quantile=RISK_QUANTILE,
+                    pool_size=4, time_budget_ms=50, seed=None, max_sweeps=10, plan_time_budget_ms=None):
+        """待ち時間のばらつきに強いルート。シナリオ全体での「待ち時間 + 門限超過ペナルティ」の分位点を最小化する。
+
+        通常の plan と制限時間付きアニーリング (シード違い) で候補を集め、全候補をシナリオで一括採点した
+        最良のルートから、全スワップ近傍を一括採点する最急降下で分位点を下げる (近傍の比較は先頭
+        RISK_SEARCH_SCENARIOS 通りだけで行う)。全候補が同じシナリオ (共通乱数) で比べられるので、
+        候補間の差がシナリオの引き方に左右されにくい。
+        plan_time_budget_ms は最初の候補を作る plan にそのまま渡す (None なら並列チェーン)。
+        """
+        if scenarios is None:
+            scenarios = WaitScenarios(self.env)
+        evaluator = ScenarioRouteEvaluator(self, scenarios, dpa_ids, auto_rest, start_time)
+        search = ScenarioRouteEvaluator(self, scenarios.head(RISK_SEARCH_SCENARIOS), dpa_ids, auto_rest, start_time)
+        rng = random.Random(seed)
+        pool = [self.plan(selected, dpa_ids, auto_rest, start_time, seed=seed, time_budget_ms=plan_time_budget_ms)]
+        for _ in range(pool_size - 1):
+            pool.append(self.anneal_timed(selected, dpa_ids, auto_rest, start_time, time_budget_ms, rng.getrandbits(32)))
+        candidates = np.unique(np.stack(pool), axis=0)
+        scores = evaluator.objective(candidates, quantile)
+        best = int(np.argmin(scores))
+        route = candidates[best]
+        if len(route) < 2:
+            return _route_array(route)
+        score = search.objective(route, quantile)[0]
+        for _ in range(max_sweeps):
+            neighbors, _ = swap_neighborhood(route)
+            scores = search.objective(neighbors, quantile)
+            best = int(np.argmin(scores))
+            if not scores[best] < score:
+                break
+            route, score = neighbors[best], scores[best]
+        return _route_array(route)
+
+    def risk_summary(self, route, dpa_ids, auto_rest, start_time, scenarios=None, start_id=ENT_ID, rested=False):
+        """ルートをシナリオで評価したリスク指標 (ScenarioRouteEvaluator.summary 参照)"""
+        if scenarios is None:
+            scenarios = WaitScenarios(self.env)
+        return ScenarioRouteEvaluator(self, scenarios, dpa_ids, auto_rest, start_time, start_id, rested).summary(route)
+
+    def optimize_dpa(self, selected, auto_rest, start_time, max_count=None, budget=None, prices=None,
+                     pool_size=2, time_budget_ms=None, refine=3, seed=None, stats=None):
+        """DPA を買う施設の組み合わせ (個数上限 max_count / 予算 budget 円) と回る順番を同時に決める。
+        価格は施設IDで引ける配列 prices (既定は CATALOG.price) を使う。
+
+        全部分集合についてアニーリングはしない。DPA 無し / 対象すべて DPA の条件で作った少数の候補ルートを、
+        条件を満たす全部分集合について DPA 行列 (行ごとに DPA を変える) で一括採点し、
+        上位 refine 個の部分集合と DPA 無しだけその DPA でルートを解き直す (EXACT_SOLVER_MAX_ATTRS 以下なら厳密解、
+        多ければ候補ルートからのウォームスタート)。採点は門限超過をペナルティで数えるので、
+        候補ルートでは間に合わなくても、順番を変えれば間に合う部分集合を取りこぼさない。
+        time_budget_ms (候補ルート1本あたり) を省略すると施設数 x DPA_POOL_MS_PER_ATTR にする。
+        戻り値の dict: route, dpa_ids, total_wait, no_dpa_wait (DPA 無しの最良), price,
+        marginal (施設ごとに DPA を1つ足した/外した時に減る待ち時間。外すと門限に間に合わなければ inf、
+        足しても外しても間に合わなければ None)
+        """
+        prices = CATALOG.price if prices is None else np.asarray(prices)
+        selected = _route_array(selected)
+        # 一日中 DPA の待ち時間以下なら買っても得をしないので候補から外す
+        eligible = [a for a in _id_list(selected) if CATALOG.dpa[a] and self.env.wait_table[a].max() > DPA_WAIT_MINUTES]
+        evaluator = BatchRouteEvaluator(self, [], auto_rest, start_time)
+        # 部分集合の比較と磨き込みは門限超過をペナルティで数える (inf だと惜しい部分集合の区別がつかない)
+        scorer = BatchRouteEvaluator(self, [], auto_rest, start_time, overtime_penalty=TIMED_OVERTIME_PENALTY)
+        rng = random.Random(seed)
+        if time_budget_ms is None:
+            time_budget_ms = DPA_POOL_MS_PER_ATTR * len(selected)
+        
+        pool = [self.anneal_timed(selected, eligible if i % 2 else [], auto_rest, start_time, time_budget_ms, rng.getrandbits(32))
+                for i in range(pool_size)]
+        routes = np.unique(np.stack(pool), axis=0)
         
-        temp = 1000.0
-        cooling_rate = 0.95
+        if len(eligible) > DPA_ENUM_MAX_ATTRS:
+            # 候補ルートそれぞれで「その施設だけ DPA にした時」の最良値を比べ、効果の大きいものに絞る
+            single = np.zeros((len(eligible), len(CATALOG)), dtype=bool)
+            single[np.arange(len(eligible)), eligible] = True
+            totals, _ = scorer.score(np.repeat(routes, len(eligible), axis=0), np.tile(single, (len(routes), 1)))
+            gain = -totals.reshape(len(routes), len(eligible)).min(axis=0)
+            eligible = [eligible[i] for i in np.sort(np.argsort(-gain, kind="stable")[:DPA_ENUM_MAX_ATTRS])]
+        m = len(eligible)
+        price = prices[eligible].astype(np.int64)
         
-        for _ in range(1000):
-            if temp < 1.0: break
-            new_route = best_route[:]
-            i, j = random.sample(range(len(new_route)), 2)
-            new_route[i], new_route[j] = new_route[j], new_route[i]
+        # 条件を満たす部分集合だけをビットマスクで列挙 (先頭は必ず空集合 = DPA 無し)
+        masks = ((np.arange(1 << m)[:, None] >> np.arange(m)) & 1).astype(bool)
+        allowed = np.ones(len(masks), dtype=bool)
+        if max_count is not None:
+            allowed &= masks.sum(axis=1) <= max_count
+        if budget is not None:
+            allowed &= masks @ price <= budget
+        masks = masks[allowed]
+        is_dpa = np.zeros((len(masks), len(CATALOG)), dtype=bool)
+        is_dpa[:, eligible] = masks
+        
+        # ルート x 部分集合を1回で採点 (ルートは全部分集合で使い回す)
+        totals, _ = scorer.score(np.repeat(routes, len(masks), axis=0), np.tile(is_dpa, (len(routes), 1)))
+        totals = totals.reshape(len(routes), len(masks))
+        subset_best, subset_route = totals.min(axis=0), totals.argmin(axis=0)
+        costs = masks @ price
+        if stats is not None:
+            stats.incr("dpa_subsets", len(masks))
+            stats.incr("dpa_rows_scored", totals.size)
+        
+        best = no_dpa = None
+        # DPA 無し (先頭の空集合) も同じように解き直し、比較の基準 no_dpa_wait を候補ルートの値で過大にしない
+        refined = list(np.lexsort((costs, subset_best))[:refine])
+        if 0 not in refined:
+            refined.append(0)
+        for j in refined:
+            dpa_ids = [a for a, on in zip(eligible, masks[j]) if on]
+            if len(selected) <= EXACT_SOLVER_MAX_ATTRS:
+                route = self.solve_exact(selected, dpa_ids, auto_rest, start_time)
+            else:
+                route = self.anneal_timed(selected, dpa_ids, auto_rest, start_time, time_budget_ms, rng.getrandbits(32),
+                                          initial_route=routes[subset_route[j]])
+            route = self.polish_swaps(route, dpa_ids, auto_rest, start_time, overtime_penalty=TIMED_OVERTIME_PENALTY)
+            penalized, end = scorer.score(route, is_dpa[j][None])
+            # (門限超過か, ペナルティ込みの値, 価格) の辞書順。間に合う組み合わせを必ず優先する
+            key = (bool(end[0] > PARK_CLOSING_MINUTES), penalized[0], costs[j])
+            if j == 0:
+                no_dpa = key
+            if best is None or key < best[0]:
+                best = (key, route, j)
+            if stats is not None:
+                stats.incr("dpa_refined")
+        (late, penalized, cost), route, j = best
+        total_wait = INF if late else penalized
+        
+        # 決めたルートのまま、各施設の DPA を1つだけ反転させた場合と比べる
+        flipped = np.repeat(is_dpa[j][None], m, axis=0)
+        flipped[np.arange(m), eligible] ^= True
+        flip_totals, _ = evaluator.score(np.repeat(route[None], m, axis=0), flipped)
+        marginal = []
+        for i, a in enumerate(eligible):
+            chosen = bool(masks[j][i])
+            if total_wait == INF and flip_totals[i] == INF:
+                saving = None  # どちらでも門限に間に合わないので比べられない
+            else:
+                saving = float(flip_totals[i] - total_wait if chosen else total_wait - flip_totals[i])
+            marginal.append({"id": a, "name": CATALOG.names[a], "price": int(price[i]), "chosen": chosen, "saving": saving})
+        return {"route": _route_array(route), "dpa_ids": _route_array([a for a, on in zip(eligible, masks[j]) if on]),
+                "total_wait": float(total_wait), "no_dpa_wait": INF if no_dpa[0] else float(no_dpa[1]),
+                "price": int(cost), "marginal": marginal}
+
+    def _chain(self, evaluator, route, rng, temp, cooling_rate, max_iter, min_temp=1.0, stats=None):
+        """route (施設ID列) をその場で更新するメトロポリス連鎖。最良解は別に保持する
+
+        近傍は anneal_timed と同じ (_random_move: スワップ・2-opt・挿入・Or-opt)。
+
+        evaluator は門限超過をペナルティで採点するもの (_chain_start 参照) を想定し、
+        最良解は (門限超過か, 採点値) の辞書順で比べて実行可能解を優先する。
+        """
+        # states[k] = k番目の施設に向かう直前の状態。近傍は変更の始まる位置 k 以降だけ再計算する
+        states = evaluator.prefix_states(route)
+        score = evaluator.state_cost(states[-1])
+        best_route, best_key = route[:], (states[-1][0] > PARK_CLOSING_MINUTES, score)
+        iterations = accepted = infeasible = lookups = 0
+        loop_start = time.perf_counter()
+        
+        for _ in range(max_iter):
+            if temp < min_temp or len(route) < 2: break
+            candidate, k = _random_move(route, rng)
+            lookups += len(candidate) - k
             
-            new_score, _, _ = self.calc_route_cost(new_route, start_time, dpa_list, auto_rest)
+            new_score, new_end = evaluator.score_from(candidate, k, states[k])
+            if new_end > PARK_CLOSING_MINUTES:
+                infeasible += 1
             
             # inf(門限オーバー)を回避しつつ最適化
-            if new_score < best_score or (new_score != float('inf') and random.random() < math.exp((best_score - new_score) / temp)):
-                best_score = new_score
-                best_route = new_route
+            if new_score < score or (new_score != INF and rng.random() < math.exp((score - new_score) / temp)):
+                route[:] = candidate
+                score = new_score
+                evaluator.prefix_states(route, states, k)
+                accepted += 1
+                key = (new_end > PARK_CLOSING_MINUTES, score)
+                if key < best_key:
+                    best_route, best_key = route[:], key
             temp *= cooling_rate
+            iterations += 1
+            if stats is not None and iterations % stats.trace_every == 0:
+                stats.record(iterations, score, best_key[1])
+        
+        if stats is not None:
+            stats.add_time("anneal_loop", time.perf_counter() - loop_start)
+            stats.incr("iterations", iterations)
+            stats.incr("accepted", accepted)
+            stats.incr("infeasible_candidates", infeasible)
+            stats.incr("wait_lookups", lookups)
+            stats.record(iterations, score, best_key[1])
+        return {"route": route, "score": score, "best_route": best_route, "best_key": best_key,
+                "iterations": iterations, "accepted": accepted, "infeasible_candidates": infeasible}
+
+    def _chain_start(self, selected, dpa_ids, auto_rest, start_time, rng):
+        """チェーン用の (ペナルティ付き evaluator, 初期ルート)。シャッフルした初期解が門限オーバーなら貪欲法の解にする"""
+        evaluator = RouteEvaluator(self, dpa_ids, auto_rest, start_time, overtime_penalty=TIMED_OVERTIME_PENALTY)
+        route = _id_list(selected)
+        rng.shuffle(route)
+        if evaluator.score(route)[1] > PARK_CLOSING_MINUTES:
+            route = evaluator.greedy_route(route)
+        return evaluator, route
+
+    def anneal(self, selected, dpa_ids, auto_rest, start_time, seed=None, stats=None):
+        rng = random.Random(seed)
+        evaluator, route = self._chain_start(selected, dpa_ids, auto_rest, start_time, rng)
+        result = self._chain(evaluator, route, rng, *_chain_schedule(len(route)), min_temp=0.0, stats=stats)
+        return _route_array(result['best_route'])
+
+    def solve_exact(self, selected, dpa_ids, auto_rest, start_time, stats=None):
+        """(訪問済み集合, 最後の施設, 休憩済み) を状態とするビットマスクDPで最小待ち時間のルートを求める。
+
+        各状態には (時刻 t, 累積待ち w) のラベルを複数持たせる。待ち時間テーブルは
+        「t + 待ち時間」が時刻に対して単調 (追い越し無し) なので、今後休憩が入らない状態では
+        早く着いたラベルは後のラベルより最大でも (到着差) 分しか待ちが増えない。
+        よって t1 <= t2 かつ w1 - t1 <= w2 - t2 なら後者を捨てても最適性は失われない。
+        休憩が入り得る状態は同じ時刻のラベル同士だけ比較する。
+        さらに暫定解 (貪欲法の解を 施設数 x EXACT_INCUMBENT_ITER_PER_ATTR 反復だけ磨いたもの) と残り施設の最小待ち時間の合計 (下界) で
+        枝刈りする。22時までに回りきれる順序が無い場合は anneal の結果を返す。
+        """
+        evaluator = RouteEvaluator(self, dpa_ids, auto_rest, start_time)
+        ids = _id_list(selected)
+        n = len(ids)
+        if n == 0:
+            return _route_array([])
+        full = (1 << n) - 1
+        fifo = self.env.is_fifo
+        last_rest_end = REST_WINDOWS[-1][1]
+        
+        # 暫定解は上界に使うだけなので安く作る (DP 本体より重くならないよう反復数を固定)
+        chain_eval = RouteEvaluator(self, dpa_ids, auto_rest, start_time, overtime_penalty=TIMED_OVERTIME_PENALTY)
+        incumbent_iter = EXACT_INCUMBENT_ITER_PER_ATTR * n
+        cooling = (TIMED_T_END / TIMED_T0_DEFAULT) ** (1 / incumbent_iter)
+        incumbent = self._chain(chain_eval, chain_eval.greedy_route(ids), random.Random(0), TIMED_T0_DEFAULT, cooling,
+                                incumbent_iter, min_temp=0.0)['best_route']
+        incumbent_score = evaluator.score(incumbent)[0]
+        # 下界: 残り施設それぞれの「開始時刻以降の最小待ち時間」の合計 (mask ごとに前計算)
+        suffix_min = evaluator.min_wait_after()
+        m0 = start_time - WAIT_TABLE_START if start_time > WAIT_TABLE_START else 0
+        min_wait = [suffix_min[a][m0] for a in ids]
+        rest_bound = [sum(min_wait[bit] for bit in range(n) if not mask >> bit & 1) for mask in range(full + 1)]
+        
+        # layers[mask][key] = [(時刻, 累積待ち, 休憩済み, 親ラベル, 施設ID), ...]
+        # key は今後休憩が入らない状態なら (last,)、入り得る状態なら (last, 時刻)
+        t0, _, rested0, _ = evaluator.start_state
+        layers = [None] * (full + 1)
+        layers[0] = {(ENT_ID, t0): [(t0, 0, rested0, None, ENT_ID)]}
+        best = None
+        expanded = pruned = 0
+        loop_start = time.perf_counter()
+        
+        # 遷移は必ずビットが増える方向なので、mask の昇順に処理すれば各集合は確定済み
+        for mask in range(full):
+            buckets = layers[mask]
+            if not buckets: continue
+            layers[mask] = None
+            remaining = [bit for bit in range(n) if not mask >> bit & 1]
+            for labels in buckets.values():
+                for label in labels:
+                    t, wait_sum, rested, _, last = label
+                    expanded += 1
+                    for bit in remaining:
+                        a = ids[bit]
+                        moved = evaluator.step(t, last, rested, a)
+                        if moved is None: continue
+                        new_t, new_rested, wait = moved
+                        new_sum = wait_sum + wait
+                        new_mask = mask | 1 << bit
+                        if new_mask == full:
+                            if best is None or (new_sum, new_t) < (best[1], best[0]):
+                                best = (new_t, new_sum, new_rested, label, a)
+                                incumbent_score = min(incumbent_score, new_sum)
+                            continue
+                        # 下界が暫定解を超えるラベルは枝刈り
+                        if new_sum + rest_bound[new_mask] > incumbent_score:
+                            pruned += 1
+                            continue
+                        nxt = layers[new_mask]
+                        if nxt is None:
+                            nxt = layers[new_mask] = {}
+                        if fifo and (new_rested or new_t > last_rest_end):
+                            _insert_label(nxt.setdefault((a,), []), (new_t, new_sum, new_rested, label, a))
+                        else:
+                            same_time = nxt.get((a, new_t))
+                            if same_time is None or new_sum < same_time[0][1]:
+                                nxt[(a, new_t)] = [(new_t, new_sum, new_rested, label, a)]
+        
+        if stats is not None:
+            stats.add_time("dp_loop", time.perf_counter() - loop_start)
+            stats.incr("dp_labels", expanded)
+            stats.incr("dp_pruned", pruned)
+            stats.record(expanded, INF if best is None else best[1], incumbent_score)
+        if best is None:
+            return self.anneal(selected, dpa_ids, auto_rest, start_time, seed=0)
+        route = []
+        label = best
+        while label[3] is not None:
+            route.append(label[4])
+            label = label[3]
+        return _route_array(route[::-1])
+
+    def anneal_timed(self, selected, dpa_ids, auto_rest, start_time, time_budget_ms=200, seed=None, stats=None,
+                     initial_route=None, start_id=ENT_ID, rested=False):
+        """制限時間いっぱいまで探索する適応型アニーリング。
+
+        近傍はスワップ・2-opt (区間反転)・挿入・Or-opt (2〜3施設の区間移動)。
+        温度は経過時間の割合で T0 から T_END へ指数的に下げ、受理率に応じて補正する。
+        最良解が長く更新されなければ最良解を崩して再出発する。
+        initial_route を渡すとランダムな並びではなくそのルート (か貪欲法の良い方) から低温で始める (ウォームスタート)。
+        """
+        deadline = time.perf_counter() + time_budget_ms / 1000
+        rng = random.Random(seed)
+        # 門限オーバーも超過分数で採点し、実行可能領域へ向かう勾配を作る
+        evaluator = RouteEvaluator(self, dpa_ids, auto_rest, start_time, overtime_penalty=TIMED_OVERTIME_PENALTY,
+                                   start_id=start_id, rested=rested)
+        warm = initial_route is not None
+        route = _id_list(initial_route if warm else selected)
+        if not warm:
+            rng.shuffle(route)
+        n = len(route)
+        if n < 2:
+            return _route_array(route)
+        
+        states = evaluator.prefix_states(route)
+        if warm:
+            greedy = evaluator.greedy_route(route)
+            if evaluator.score(greedy)[0] < evaluator.state_cost(states[-1]):
+                route = greedy
+                states = evaluator.prefix_states(route)
+        elif states[-1][0] > PARK_CLOSING_MINUTES:
+            # ランダムな初期解が門限オーバーなら貪欲法の解から始める
+            route = evaluator.greedy_route(route)
+            states = evaluator.prefix_states(route)
+        score = evaluator.state_cost(states[-1])
+        # 最良解は (門限超過か, 採点値) の辞書順で比べ、実行可能解を必ず優先する
+        best_route, best_key = route[:], (states[-1][0] > PARK_CLOSING_MINUTES, score)
+        
+        # 初期温度: ランダムな近傍で悪化した量の平均を 50% の確率で受理できる温度
+        deltas = []
+        for _ in range(30):
+            candidate, k = _random_move(route, rng)
+            new_score, _ = evaluator.score_from(candidate, k, states[k])
+            if new_score > score:
+                deltas.append(new_score - score)
+        temp0 = sum(deltas) / len(deltas) / math.log(2) if deltas else TIMED_T0_DEFAULT
+        if warm:
+            temp0 *= WARM_T0_SCALE
+        temp0 = max(temp0, TIMED_T_END * 2)
+        
+        adapt = 1.0
+        stall_limit = TIMED_STALL_PER_ATTR * n
+        since_best = window_accepted = 0
+        iterations = accepted = infeasible = restarts = lookups = 0
+        loop_start = time.perf_counter()
+        temp = temp0
+        while True:
+            if iterations % 32 == 0:
+                now = time.perf_counter()
+                if now >= deadline: break
+                frac = 1 - (deadline - now) * 1000 / time_budget_ms
+                temp = adapt * temp0 * (TIMED_T_END / temp0) ** frac
+            iterations += 1
             
+            candidate, k = _random_move(route, rng)
+            lookups += n - k
+            new_score, new_end = evaluator.score_from(candidate, k, states[k])
+            if new_end > PARK_CLOSING_MINUTES:
+                infeasible += 1
+            if new_score <= score or rng.random() < math.exp((score - new_score) / temp):
+                route, score = candidate, new_score
+                evaluator.prefix_states(route, states, k)
+                window_accepted += 1
+                accepted += 1
+                key = (new_end > PARK_CLOSING_MINUTES, score)
+                if key < best_key:
+                    best_route, best_key = route[:], key
+                    since_best = 0
+            since_best += 1
+            if stats is not None and iterations % stats.trace_every == 0:
+                stats.record(iterations, score, best_key[1])
+            
+            # 受理率が低すぎれば温度を上げ、高すぎれば下げる
+            if iterations % TIMED_WINDOW == 0:
+                rate = window_accepted / TIMED_WINDOW
+                if rate < 0.02:
+                    adapt *= 1.5
+                elif rate > 0.5:
+                    adapt *= 0.7
+                window_accepted = 0
+            
+            # 停滞したら最良解を崩して再出発
+            if since_best >= stall_limit:
+                route = _kick(best_route, rng)
+                states = evaluator.prefix_states(route)
+                score = evaluator.state_cost(states[-1])
+                adapt = 1.0
+                since_best = 0
+                restarts += 1
+        
+        if stats is not None:
+            stats.add_time("anneal_loop", time.perf_counter() - loop_start)
+            stats.incr("iterations", iterations)
+            stats.incr("accepted", accepted)
+            stats.incr("infeasible_candidates", infeasible)
+            stats.incr("restarts", restarts)
+            # 待ち時間テーブルの参照回数 (= score_from で再計算した施設数)。ホットパスの仕事量の目安
+            stats.incr("wait_lookups", lookups)
+            stats.info['initial_temperature'] = temp0
+            stats.record(iterations, score, best_key[1])
+        return _route_array(best_route)
+
+    def replan(self, route, completed, current_id, now, dpa_ids, auto_rest, lunch_taken=False,
+               observed_waits=None, time_budget_ms=None, seed=None, stats=None):
+        """来園途中の再計画。体験済みを除いた残りだけを、現在地・現在時刻から最適化し直す。
+
+        前回のルート (route) から体験済みを除いた並びを初期解にするので、短い探索でも前回の計画以上から始まる。
+        observed_waits ({施設ID: 今の待ち分数}) があればその施設の待ち時間カーブを観測値に合わせて補正する。
+        戻り値は (残りのルート, total_wait, end_time, timeline)。total_wait と timeline は現在地から先の分だけ。
+        """
+        if time_budget_ms is None:
+            time_budget_ms = REPLAN_TIME_BUDGET_MS
+        done = set(_id_list(completed))
+        remaining = [a for a in _id_list(route) if a not in done and a != ENT_ID]
+        core = self
+        if observed_waits:
+            core = OptimizationCore(self.env.with_observed_waits(observed_waits, now), self.fs_seed)
+        if stats is not None:
+            stats.info.update(solver="replan", attractions=len(remaining))
+            with stats.timer("plan"):
+                suffix = core.anneal_timed(remaining, dpa_ids, auto_rest, now, time_budget_ms, seed, stats=stats,
+                                           initial_route=remaining, start_id=current_id, rested=lunch_taken)
+        else:
+            suffix = core.anneal_timed(remaining, dpa_ids, auto_rest, now, time_budget_ms, seed,
+                                       initial_route=remaining, start_id=current_id, rested=lunch_taken)
+        total_w, end_t, timeline = core.calc_route_cost(suffix, now, dpa_ids, auto_rest, stats=stats,
+                                                        start_id=current_id, rested=lunch_taken)
+        return suffix, total_w, end_t, timeline
+
+    def plan(self, selected, dpa_ids, auto_rest, start_time, seed=None, time_budget_ms=None, stats=None):
+        """選択数が少なければ厳密解、多ければアニーリングでルートを求める。
+
+        time_budget_ms を指定すると制限時間付きの anneal_timed を、指定しなければ anneal_parallel を使う。
+        どちらも門限オーバーを超過分数で採点するので、時間予算なしでも実行可能なルートへ向かう。
+        anneal_parallel の解がそれでも門限を越えたら、その解から反復数固定のチェーンで粘る (seed で結果が決まる)。
+        stats に PlanStats を渡すと、使ったソルバーと計測値をそこに記録する。
+        """
+        if len(selected) <= EXACT_SOLVER_MAX_ATTRS:
+            solver = "exact"
+        else:
+            solver = "anneal_timed" if time_budget_ms is not None else "anneal_parallel"
+        if stats is None:
+            return self._plan(solver, selected, dpa_ids, auto_rest, start_time, seed, time_budget_ms, None)
+        stats.info.update(solver=solver, attractions=len(selected))
+        with stats.timer("plan"):
+            return self._plan(solver, selected, dpa_ids, auto_rest, start_time, seed, time_budget_ms, stats)
+
+    def _plan(self, solver, selected, dpa_ids, auto_rest, start_time, seed, time_budget_ms, stats):
+        if solver == "exact":
+            return self.solve_exact(selected, dpa_ids, auto_rest, start_time, stats=stats)
+        if solver == "anneal_timed":
+            return self.anneal_timed(selected, dpa_ids, auto_rest, start_time, time_budget_ms, seed, stats=stats)
+        best_route, _ = self.anneal_parallel(selected, dpa_ids, auto_rest, start_time, seed=seed, stats=stats)
+        if RouteEvaluator(self, dpa_ids, auto_rest, start_time).score(_id_list(best_route))[0] == INF:
+            if stats is not None:
+                stats.incr("plan_rescues")
+            # 制限時間ではなく反復数で止めるので、同じ seed なら同じルートになる
+            evaluator = RouteEvaluator(self, dpa_ids, auto_rest, start_time, overtime_penalty=TIMED_OVERTIME_PENALTY)
+            temp, _, max_iter = _chain_schedule(len(best_route))
+            temp *= WARM_T0_SCALE
+            result = self._chain(evaluator, _id_list(best_route), random.Random(seed), temp,
+                                 (TIMED_T_END / temp) ** (1 / max_iter), max_iter, min_temp=0.0, stats=stats)
+            best_route = _route_array(result['best_route'])
         return best_route
 
+    def anneal_parallel(self, selected, dpa_ids, auto_rest, start_time, n_chains=None, seed=None, mode="independent", stats=None):
+        """複数チェーンをプロセスプールで並列に回し、(最良ルート, チェーンごとの統計) を返す。
+
+        mode="independent" は各チェーンが anneal と同じスケジュールで独立に探索し、
+        mode="replica" は温度の異なるチェーン間で一定間隔ごとに解を交換する (レプリカ交換法)。
+        """
+        n_chains = n_chains or os.cpu_count() or 1
+        if mode not in ("independent", "replica"):
+            raise ValueError(f"unknown mode: {mode}")
+        if not _pool_usable(_run_chain if mode == "independent" else _run_replica_segment):
+            # 並列にできないなら全コア分のチェーンを順に回しても遅くなるだけなので絞る
+            n_chains = min(n_chains, SERIAL_MAX_CHAINS)
+        seed_rng = random.Random(seed)
+        seeds = [seed_rng.getrandbits(32) for _ in range(n_chains)]
+        if mode == "independent":
+            chains = _pool_map(_run_chain, [(self.env.args, self.fs_seed, _route_array(selected), _route_array(dpa_ids), auto_rest, start_time, s) for s in seeds])
+        else:
+            chains = self._replica_exchange(selected, dpa_ids, auto_rest, start_time, seeds, seed_rng)
+
+        for chain_id, chain in enumerate(chains):
+            chain['chain'] = chain_id
+            chain['acceptance_rate'] = chain['accepted'] / chain['iterations'] if chain['iterations'] else 0.0
+        best = min(chains, key=lambda c: (c['total_wait'], c['end_time']))
+        if stats is not None:
+            # チェーンはワーカー側で動くので、各チェーンが持ち帰ったカウンタ・タイマーを足し合わせ、
+            # 収束トレースは最良解を出したチェーンのものを使う (anneal_loop の秒数は全チェーンの合計)
+            stats.info.update(mode=mode, chains=len(chains), best_chain=best['chain'])
+            for chain in chains:
+                stats.merge(chain['counters'], chain['timers'])
+            stats.trace.extend(best['trace'])
+        return best['route'], chains
+
+    def _replica_exchange(self, selected, dpa_ids, auto_rest, start_time, seeds, rng):
+        n = len(seeds)
+        # 温度は低温(index 0)から高温へ等比で並べる
+        temps = [REPLICA_T_MIN * (REPLICA_T_MAX / REPLICA_T_MIN) ** (r / max(1, n - 1)) for r in range(n)]
+        routes = [self._chain_start(selected, dpa_ids, auto_rest, start_time, random.Random(s))[1] for s in seeds]
+        scores = [INF] * n
+        best = [((True, INF), route[:]) for route in routes]
+        iterations, accepted, exchanges = [0] * n, [0] * n, [0] * n
+        replica_stats = [PlanStats() for _ in range(n)]
+        
+        for round_no in range(REPLICA_ROUNDS):
+            segments = _pool_map(_run_replica_segment, [
+                (self.env.args, self.fs_seed, _route_array(dpa_ids), auto_rest, start_time, routes[r], temps[r], REPLICA_SEGMENT_ITER, rng.getrandbits(32))
+                for r in range(n)])
+            for r, seg in enumerate(segments):
+                routes[r], scores[r] = seg['route'], seg['score']
+                replica_stats[r].merge(seg['counters'], seg['timers'])
+                # セグメント内の反復数をレプリカ通しの反復数にずらし、最良解はそれまでの最良と合わせる
+                replica_stats[r].trace += [(iterations[r] + i, cur, min(b, best[r][0][1])) for i, cur, b in seg['trace']]
+                iterations[r] += seg['iterations']
+                accepted[r] += seg['accepted']
+                if seg['best_key'] < best[r][0]:
+                    best[r] = (seg['best_key'], seg['best_route'])
+            
+            # 隣り合う温度のチェーン間で解を交換 (偶数ラウンドと奇数ラウンドで組を交互にずらす)
+            for r in range(round_no % 2, n - 1, 2):
+                e_cold, e_hot = scores[r], scores[r + 1]
+                if e_cold == INF or e_hot == INF:
+                    swap = e_cold == INF and e_hot != INF
+                else:
+                    delta = (1 / temps[r] - 1 / temps[r + 1]) * (e_cold - e_hot)
+                    swap = delta >= 0 or rng.random() < math.exp(delta)
+                if swap:
+                    routes[r], routes[r + 1] = routes[r + 1], routes[r]
+                    scores[r], scores[r + 1] = scores[r + 1], scores[r]
+                    exchanges[r] += 1
+                    exchanges[r + 1] += 1
+
+        stats = []
+        for r in range(n):
+            evaluator = RouteEvaluator(self, dpa_ids, auto_rest, start_time)
+            total_wait, end_time = evaluator.score(best[r][1])
+            stats.append({"seed": seeds[r], "temperature": temps[r], "route": _route_array(best[r][1]),
+                          "total_wait": total_wait, "end_time": end_time,
+                          "iterations": iterations[r], "accepted": accepted[r], "exchanges": exchanges[r],
+                          "infeasible_candidates": replica_stats[r].counters.get("infeasible_candidates", 0),
+                          "counters": replica_stats[r].counters, "timers": replica_stats[r].timers,
+                          "trace": replica_stats[r].trace})
+        return stats
+
+# これ以下の選択数なら厳密解 (ビットマスクDP) を使う。9施設で平均140ms程度、以降は指数的に増える
+EXACT_SOLVER_MAX_ATTRS = 8
+EXACT_INCUMBENT_ITER_PER_ATTR = 40  # solve_exact の暫定解 (枝刈りの上界) を磨く反復数は施設数 x これ
+
+def _insert_label(labels, label):
+    # t1 <= t2 かつ w1 - t1 <= w2 - t2 のとき前者が後者を支配する (solve_exact 参照)
+    t, slack = label[0], label[1] - label[0]
+    for other in labels:
+        if other[0] <= t and other[1] - other[0] <= slack:
+            return
+    labels[:] = [other for other in labels if not (t <= other[0] and slack <= other[1] - other[0])]
+    labels.append(label)
+
+# ------------------------------------------
+# 制限時間付きアニーリングの近傍
+# ------------------------------------------
+TIMED_T0_DEFAULT = 50.0
+TIMED_T_END = 0.5
+TIMED_OVERTIME_PENALTY = 100  # 門限超過1分あたり待ち時間100分相当
+TIMED_WINDOW = 200          # 受理率を測る区間 (反復数)
+TIMED_STALL_PER_ATTR = 200  # 施設数 x この反復数だけ改善が無ければ再出発
+WARM_T0_SCALE = 0.2         # ウォームスタート時は良い解を崩しすぎないよう初期温度を下げる
+REPLAN_TIME_BUDGET_MS = 30  # 再計画の探索時間 (タイムライン作成込みで 50ms 以内に収める)
+CHAIN_ITER_PER_ATTR = 500   # anneal / 並列チェーンの反復数は施設数 x これ
+
+def _chain_schedule(n):
+    """anneal と並列チェーンの (初期温度, 冷却率, 反復数)。反復数の最後で TIMED_T_END まで下がるようにする"""
+    max_iter = CHAIN_ITER_PER_ATTR * max(n, 1)
+    return TIMED_T0_DEFAULT, (TIMED_T_END / TIMED_T0_DEFAULT) ** (1 / max_iter), max_iter
+
+def _random_move(route, rng):
+    """ランダムな近傍を1つ作り (新ルート, 変更の始まる位置) を返す"""
+    n = len(route)
+    kind = rng.random() if n >= 3 else 0.0
+    if kind < 0.25:
+        # スワップ
+        i, j = rng.sample(range(n), 2)
+        candidate = route[:]
+        candidate[i], candidate[j] = candidate[j], candidate[i]
+        return candidate, min(i, j)
+    if kind < 0.5:
+        # 2-opt: route[i..j] を反転
+        i, j = sorted(rng.sample(range(n), 2))
+        return route[:i] + route[i:j + 1][::-1] + route[j + 1:], i
+    # 挿入 (1施設) / Or-opt (2〜3施設の区間を別の位置へ移動)
+    seg = 1 if kind < 0.75 else rng.randint(2, min(3, n - 1))
+    i = rng.randrange(n - seg + 1)
+    rest = route[:i] + route[i + seg:]
+    p = rng.randrange(len(rest) + 1)
+    if p == i:
+        p = (p + 1) % (len(rest) + 1)
+    return rest[:p] + route[i:i + seg] + rest[p:], min(i, p)
+
+def _kick(route, rng):
+    # ダブルブリッジ (A B C D -> A C B D)。短いルートはシャッフル
+    n = len(route)
+    if n < 8:
+        kicked = route[:]
+        rng.shuffle(kicked)
+        return kicked
+    a, b, c = sorted(rng.sample(range(1, n), 3))
+    return route[:a] + route[b:c] + route[a:b] + route[c:]
+
+# ------------------------------------------
+# 並列実行 (プロセスプール)
+# ------------------------------------------
+REPLICA_T_MIN = 1.0
+REPLICA_T_MAX = 200.0
+REPLICA_ROUNDS = 20
+REPLICA_SEGMENT_ITER = 50
+
+_PROCESS_POOL = None
+_POOL_UNUSABLE = False  # 一度プールが使えないと分かったら、以後は作り直さず同一プロセスで実行する
+SERIAL_MAX_CHAINS = 2   # プールが使えず同一プロセスで順に回す時のチェーン数の上限 (実時間を増やさない)
+
+def _process_pool():
+    global _PROCESS_POOL
+    if _PROCESS_POOL is None:
+        _PROCESS_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _PROCESS_POOL
+
+def _pool_usable(fn):
+    """fn をプロセスプールで実行できそうか。
+
+    プールが壊れていないかに加え、fn を pickle できるかを先に試す。Streamlit のように再実行のたびに
+    __main__ を作り直す環境では、前回の実行で作ったオブジェクトから参照した関数は pickle できない。
+    """
+    if _POOL_UNUSABLE:
+        return False
+    try:
+        pickle.dumps(fn)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+def _pool_map(fn, arg_list):
+    """プロセスプールで並列に実行する。
+
+    fn を pickle できなければ (_pool_usable 参照) 今回だけ同一プロセスで順に実行する。ワーカーが落ちた・
+    タスクを pickle できない場合はプールを閉じて以後も同一プロセスで実行する。タスク内で起きた例外はそのまま送出する。
+    """
+    global _PROCESS_POOL, _POOL_UNUSABLE
+    if _pool_usable(fn):
+        try:
+            futures = [_process_pool().submit(fn, *args) for args in arg_list]
+            return [f.result() for f in futures]
+        except (concurrent.futures.process.BrokenProcessPool, pickle.PicklingError):
+            _POOL_UNUSABLE = True
+            if _PROCESS_POOL is not None:
+                _PROCESS_POOL.shutdown(wait=False, cancel_futures=True)
+                _PROCESS_POOL = None
+    return [fn(*args) for args in arg_list]
+
+@functools.lru_cache(maxsize=16)
+def _worker_core(env_args, fs_seed):
+    # 同じ環境のリクエストはワーカー内で OptimizationCore を使い回す
+    return OptimizationCore(EnvironmentAI(*env_args), fs_seed)
+
+def _run_chain(env_args, fs_seed, selected, dpa_ids, auto_rest, start_time, seed):
+    core = _worker_core(env_args, fs_seed)
+    rng = random.Random(seed)
+    evaluator, route = core._chain_start(selected, dpa_ids, auto_rest, start_time, rng)
+    # 計測値はワーカー側で集め、カウンタ・タイマー・トレースを結果に載せて親プロセスに返す
+    stats = PlanStats()
+    result = core._chain(evaluator, route, rng, *_chain_schedule(len(route)), min_temp=0.0, stats=stats)
+    # 結果はペナルティ無しで採点し直す (門限オーバーは inf)
+    total_wait, end_time = RouteEvaluator(core, dpa_ids, auto_rest, start_time).score(result['best_route'])
+    return {"seed": seed, "route": _route_array(result['best_route']),
+            "total_wait": total_wait, "end_time": end_time,
+            "iterations": result['iterations'], "accepted": result['accepted'],
+            "infeasible_candidates": result['infeasible_candidates'],
+            "counters": stats.counters, "timers": stats.timers, "trace": stats.trace}
+
+def _run_replica_segment(env_args, fs_seed, dpa_ids, auto_rest, start_time, route, temp, n_iter, seed):
+    core = _worker_core(env_args, fs_seed)
+    evaluator = RouteEvaluator(core, dpa_ids, auto_rest, start_time, overtime_penalty=TIMED_OVERTIME_PENALTY)
+    stats = PlanStats()
+    result = core._chain(evaluator, route, random.Random(seed), temp, 1.0, n_iter, min_temp=0.0, stats=stats)
+    result.update(counters=stats.counters, timers=stats.timers, trace=stats.trace)
+    return result
+
 # ==========================================
 # 4. 公式アプリ風 UI/UX
 # ==========================================
+# Streamlit は操作のたびにスクリプト全体を再実行するので、重い物は st.cache_* でセッション間共有する
+PLAN_CACHE_TTL_SECONDS = 30 * 60
+PLAN_CACHE_MAX_ENTRIES = 256  # 超えたら古いものから捨てる
+MAP_CACHE_MAX_ENTRIES = 64
+UI_PLAN_SEED = 0  # 同じ条件なら同じプランになるよう (キャッシュできるよう) シードを固定
+# Streamlit は再実行のたびに __main__ を作り直すので、キャッシュしたコアからはプロセスプールへ関数を送れない。
+# UI ではプールを使う anneal_parallel ではなく、同一プロセスの制限時間付きアニーリングでプランを作る
+UI_PLAN_TIME_BUDGET_MS = 200
+
+def _ui_cache(decorator):
+    # バッチ処理などで Streamlit の外から import された時はキャッシュを付けない (No runtime の警告を出さない)
+    return decorator if st.runtime.exists() else (lambda fn: fn)
+
+@_ui_cache(st.cache_resource)
+def _shared_core(env_args):
+    """(日付, 降水確率, 祝日) ごとの環境と最適化コア。テーブル類は読み取り専用なのでセッション間で共有できる"""
+    return OptimizationCore(EnvironmentAI(*env_args))
+
+@_ui_cache(st.cache_resource)
+def _attractions_by_area():
+    grouped = {}
+    for name, data in MASTER_DB.items():
+        grouped.setdefault(data['area'], []).append(name)
+    return grouped
+
+def plan_cache_key(env, selected, dpa_ids, auto_rest, start_time, seed, risk=False, dpa_limits=None):
+    """プラン結果のキャッシュキー (正規化した条件の SHA-256)。
+
+    選択は順不同なのでソートし、環境は結果を決める table_key (曜日区分・雨区分・祝日) で表す。
+    リスク評価では雨がシナリオごとに降水確率で決まるので、降水確率そのものもキーに入れる。
+    """
+    payload = {"env": list(env.table_key), "selected": sorted(_id_list(selected)), "dpa": sorted(_id_list(dpa_ids)),
+               "auto_rest": bool(auto_rest), "start": int(start_time), "seed": seed,
+               "risk": env.rain_prob if risk else None, "dpa_limits": None if dpa_limits is None else list(dpa_limits)}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+@_ui_cache(st.cache_data(ttl=PLAN_CACHE_TTL_SECONDS, max_entries=PLAN_CACHE_MAX_ENTRIES, show_spinner=False))
+def _cached_plan(cache_key, _env_args, _selected, _dpa_ids, _auto_rest, _start_time, _seed, _risk=False, _dpa_limits=None):
+    # キャッシュは cache_key だけで引く (先頭が _ の引数は Streamlit がハッシュしない)
+    core = _shared_core(_env_args)
+    stats = PlanStats()
+    risk = dpa_choice = None
+    if _dpa_limits is not None:
+        # DPA の組み合わせと順番を同時に決める (リスク評価はそのルートについてだけ行う)
+        max_count, budget = _dpa_limits
+        with stats.timer("optimize_dpa"):
+            dpa_choice = core.optimize_dpa(_selected, _auto_rest, _start_time, max_count, budget, seed=_seed, stats=stats)
+        route, _dpa_ids = dpa_choice['route'], dpa_choice['dpa_ids']
+        if _risk:
+            risk = core.risk_summary(route, _dpa_ids, _auto_rest, _start_time)
+    elif _risk:
+        # 待ち時間のブレを考慮する場合は P90 を最小化したルートにし、そのリスク指標も返す
+        scenarios = WaitScenarios(core.env)
+        with stats.timer("plan_robust"):
+            route = core.plan_robust(_selected, _dpa_ids, _auto_rest, _start_time, scenarios, seed=_seed,
+                                     plan_time_budget_ms=UI_PLAN_TIME_BUDGET_MS)
+        risk = core.risk_summary(route, _dpa_ids, _auto_rest, _start_time, scenarios)
+    else:
+        route = core.plan(_selected, _dpa_ids, _auto_rest, _start_time, seed=_seed, time_budget_ms=UI_PLAN_TIME_BUDGET_MS,
+                          stats=stats)
+    total_w, end_t, timeline = core.calc_route_cost(route, _start_time, _dpa_ids, _auto_rest, stats=stats)
+    return {"route": _id_list(route), "dpa_ids": _id_list(_dpa_ids), "total_wait": total_w, "end_time": end_t,
+            "timeline": timeline, "stats": stats, "risk": risk, "dpa_choice": dpa_choice}
+
+def _timeline_card(item):
+    # 時間フォーマット
+    a_h, a_m = item['arrive'] // 60, item['arrive'] % 60
+    s_h, s_m = item['start'] // 60, item['start'] % 60
+    e_h, e_m = item['end'] // 60, item['end'] % 60
+    
+    badge = ""
+    border_color = "#AAAAAA"
+    if item['area'] in AREA_INFO and item['area'] != "NA":
+        bg_color = AREA_INFO[item['area']]['color']
+        border_color = bg_color
+        badge = f"<span class='area-badge' style='background:{bg_color};'>{AREA_INFO[item['area']]['name']}</span><br>"
+    
+    icon = "🎪"
+    if item['type'] == 'Travel': icon = "🚶"
+    elif item['type'] == 'Rest': icon = "🍽️"
+    
+    wait_text = f"<span class='wait-time'>待ち時間: {item['wait']}分</span> | " if item['wait'] > 0 else ""
+    
+    return f"""
+<div class='app-card' style='border-left-color: {border_color};'>
+    {badge}
+    <span class='time-text'>{a_h:02d}:{a_m:02d}</span>
+    <span style='font-size:1.1em; font-weight:700;'>{icon} {item['name']}</span>
+    <div style='color:#666666; font-size:0.9em; margin-top:8px; padding-left:70px;'>
+        {wait_text}体験開始: {s_h:02d}:{s_m:02d} ～ 終了: {e_h:02d}:{e_m:02d} ({item['dur']}分)
+    </div>
+</div>
+"""
+
+@_ui_cache(st.cache_data(max_entries=MAP_CACHE_MAX_ENTRIES, show_spinner=False))
+def _route_map_figure(route_ids):
+    """出発地点 + 体験順の施設IDタプルごとの移動ルート図"""
+    import plotly.graph_objects as go
+    
+    xs = [CATALOG.pos[a][0] for a in route_ids]
+    ys = [CATALOG.pos[a][1] for a in route_ids]
+    fig_map = go.Figure()
+    # エリアごとに1系列 (凡例に出る順は初登場順)
+    for area_code in dict.fromkeys(CATALOG.area_code(a) for a in route_ids):
+        idx = [i for i, a in enumerate(route_ids) if CATALOG.area_code(a) == area_code]
+        fig_map.add_trace(go.Scatter(x=[xs[i] for i in idx], y=[ys[i] for i in idx], mode='markers+text',
+                                     text=[CATALOG.names[route_ids[i]] for i in idx], name=AREA_INFO[area_code]['name'],
+                                     marker=dict(color=AREA_INFO[area_code]['color'], size=14, line=dict(width=1, color='#FFFFFF')),
+                                     textposition='top center'))
+    
+    fig_map.add_trace(go.Scatter(x=xs, y=ys, mode='lines', 
+                                 line=dict(color='#1F3C88', width=2, dash='dot'), showlegend=False))
+    fig_map.update_layout(
+        paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='#F8F9FA', font_color='#333333',
+        xaxis=dict(visible=False), yaxis=dict(visible=False), legend_title_text='area',
+        title=dict(text="本日の移動ルート", font=dict(color="#1F3C88", size=18, family="M PLUS 1p")),
+        height=600, margin=dict(l=0, r=0, t=50, b=0)
+    )
+    return fig_map
+
+def _render_dpa_choice(choice):
+    chosen = [row['name'] for row in choice['marginal'] if row['chosen']]
+    if not chosen:
+        st.info("💎 この条件では DPA を買わないプランが最適です。")
+    elif choice['no_dpa_wait'] == INF:
+        st.success(f"💎 おすすめの DPA: {'、'.join(chosen)} (計 {choice['price']:,} 円・目安)。DPA 無しでは 22:00 までに回りきれません。")
+    else:
+        st.success(f"💎 おすすめの DPA: {'、'.join(chosen)} (計 {choice['price']:,} 円・目安)。"
+                   f"DPA 無しより待ち時間が約 {choice['no_dpa_wait'] - choice['total_wait']:.0f} 分短くなります。")
+    with st.expander("DPA ごとの効果 (このルートで1つだけ足す/外した場合)"):
+        rows = []
+        for row in choice['marginal']:
+            if row['saving'] is None:
+                effect = "-"
+            elif row['saving'] == INF:
+                effect = "外すと 22:00 に間に合わない" if row['chosen'] else "足すと 22:00 に間に合う"
+            else:
+                effect = f"{row['saving']:.0f} 分"
+            rows.append({"施設": row['name'], "価格 (目安)": f"{row['price']:,} 円", "購入": "✔" if row['chosen'] else "",
+                         "短縮できる待ち時間": effect})
+        st.dataframe(rows, hide_index=True)
+
 def main():
     st.set_page_config(page_title="TDS コンシェルジュ", layout="wide")
     
@@ -271,24 +1637,29 @@ def main():
         is_holiday = st.checkbox("祝日・長期休暇", value=False)
         rain_prob = st.slider("降水確率 (%)", 0, 100, 10)
         auto_rest = st.toggle("🍽️ 食事休憩を自動で組み込む", value=True)
+        risk_mode = st.toggle("🎲 待ち時間のブレを考慮する", value=False, help="待ち時間を1000通りに揺らして評価し、悪い方から1割のケースでも回りやすいプランにします")
+
+        st.divider()
+        st.markdown("### 💎 DPA (ディズニー・プレミアアクセス)")
+        dpa_auto = st.radio("DPA の選び方", ["自分で選ぶ", "おまかせ (上限・予算内で最適化)"], horizontal=True,
+                            label_visibility="collapsed") != "自分で選ぶ"
+        dpa_limits = None
+        if dpa_auto:
+            col_n, col_y = st.columns(2)
+            dpa_limits = (col_n.number_input("購入数の上限", 0, 10, 2), col_y.number_input("予算 (円)", 0, 30000, 5000, step=500))
 
         st.divider()
         st.markdown("### 📍 目的地を選択")
         
         selected_attrs = []
         dpa_list = []
-        grouped = {}
-        for name, data in MASTER_DB.items():
-            grouped.setdefault(data['area'], []).append(name)
-            
-        for area_code, attrs in grouped.items():
-            if area_code == "ENT": continue
+        for area_code, attrs in _attractions_by_area().items():
             with st.expander(f"{AREA_INFO[area_code]['name']}"):
                 for attr in attrs:
                     if st.checkbox(attr, key=f"sel_{attr}"):
                         selected_attrs.append(attr)
-                        # DPAの選択 (FS含む)
-                        if MASTER_DB[attr].get('dpa'):
+                        # DPAの選択 (FS含む)。おまかせの場合は最適化で決める
+                        if MASTER_DB[attr].get('dpa') and not dpa_auto:
                             if st.checkbox("┗ 💎 DPAを利用する", key=f"dpa_{attr}"):
                                 dpa_list.append(attr)
 
@@ -299,83 +1670,241 @@ def main():
     start_offset = entry_time.hour * 60 + entry_time.minute
 
     # --- 実行 ---
-    env = EnvironmentAI(target_date, rain_prob, is_holiday)
-    core = OptimizationCore(env)
+    env_args = (target_date, rain_prob, is_holiday)
+    core = _shared_core(env_args)
+    selected_ids = CATALOG.encode(selected_attrs)
+    dpa_ids = CATALOG.encode(dpa_list)
+    # 条件が変わったら保存済みのプランは使わない
+    plan_key = plan_cache_key(core.env, selected_ids, dpa_ids, auto_rest, start_offset, UI_PLAN_SEED, risk_mode, dpa_limits)
     
     if st.button("✨ プランを作成する", use_container_width=True):
         with st.spinner("最適なルートを計算しています..."):
-            best_route = core.anneal(selected_attrs, dpa_list, auto_rest, start_offset)
-            total_w, end_t, timeline = core.calc_route_cost(best_route, start_offset, dpa_list, auto_rest)
+            result = _cached_plan(plan_key, env_args, selected_ids, dpa_ids, auto_rest, start_offset, UI_PLAN_SEED,
+                                  risk_mode, dpa_limits)
+        st.session_state['plan'] = {**result, "key": plan_key, "completed": [], "replanned": False, "start_id": ENT_ID}
 
-        if end_t > PARK_CLOSING_MINUTES or total_w == float('inf'):
-            st.error("⚠️ 22:00までにすべての施設を回りきれません。選択数を減らすか、DPAのご利用をご検討ください。")
-            return
-        
-        # 概要
-        col1, col2, col3 = st.columns(3)
-        end_time_str = f"{end_t // 60:02d}:{end_t % 60:02d}"
+    plan = st.session_state.get('plan')
+    if plan is None or plan['key'] != plan_key:
+        return
+    # おまかせの場合は最適化で決めた DPA を使う
+    dpa_ids = plan['dpa_ids']
+
+    # --- 来園中の再計画 (残りだけを現在地から組み直す) ---
+    with st.expander("🔄 現在地から再計画する"):
+        route_ids = plan['route']
+        st.session_state.setdefault("replan_now", datetime.now().time().replace(second=0, microsecond=0))
+        col_now, col_loc = st.columns(2)
+        now = col_now.time_input("現在時刻", key="replan_now")
+        current_id = col_loc.selectbox("現在地", [ENT_ID] + sorted(route_ids), format_func=CATALOG.names.__getitem__, key="replan_loc")
+        completed = st.multiselect("体験済みの施設", sorted(route_ids), format_func=CATALOG.names.__getitem__, key="replan_done")
+        lunch_taken = st.checkbox("食事休憩は済んだ", key="replan_lunch")
+        observed_ids = st.multiselect("待ち時間を確認した施設", [a for a in sorted(route_ids) if a not in completed],
+                                      format_func=CATALOG.names.__getitem__, key="replan_observed")
+        observed_waits = {a: st.number_input(f"{CATALOG.names[a]} の今の待ち時間 (分)", 0, 300, 30, step=5, key=f"observed_{a}")
+                          for a in observed_ids}
+        if st.button("🔄 残りのプランを再計算する", use_container_width=True):
+            stats = PlanStats()
+            # 前回のルートの並びを初期解にして、残りだけを短時間で探索し直す
+            suffix, total_w, end_t, timeline = core.replan(route_ids, completed, current_id, now.hour * 60 + now.minute,
+                                                           dpa_ids, auto_rest, lunch_taken, observed_waits, stats=stats)
+            done = [a for a in route_ids if a in completed]
+            risk = None
+            if risk_mode:
+                risk = core.risk_summary(suffix, dpa_ids, auto_rest, now.hour * 60 + now.minute,
+                                         start_id=current_id, rested=lunch_taken)
+            plan = st.session_state['plan'] = {**plan, "route": done + _id_list(suffix), "completed": done, "replanned": True,
+                                               "start_id": current_id, "total_wait": total_w, "end_time": end_t,
+                                               "timeline": timeline, "stats": stats, "risk": risk}
+
+    total_w, end_t, timeline, stats = plan['total_wait'], plan['end_time'], plan['timeline'], plan['stats']
+    if plan['risk'] is not None:
+        # 待ち時間のブレを考慮した見込み (シナリオでの分布)
+        risk = plan['risk']
+        col_e, col_p, col_m = st.columns(3)
+        col_e.metric("総待ち時間の期待値", f"{risk['expected_wait']:.0f} 分", help=f"悪い方から1割のケース: {risk['p90_wait']:.0f} 分")
+        col_p.metric("終了時刻 (90%の確率でこれより前)", _fmt_minutes(risk['p90_end']))
+        col_m.metric("22:00 に間に合わない確率", f"{risk['miss_prob']:.0%}")
+    if plan['dpa_choice'] is not None:
+        _render_dpa_choice(plan['dpa_choice'])
+    if end_t > PARK_CLOSING_MINUTES or total_w == float('inf'):
+        st.error("⚠️ 22:00までにすべての施設を回りきれません。選択数を減らすか、DPAのご利用をご検討ください。")
+        return
+    
+    # 概要
+    col1, col2, col3 = st.columns(3)
+    end_time_str = f"{end_t // 60:02d}:{end_t % 60:02d}"
+    if plan['replanned']:
+        col1.metric("残り施設数", f"{len(plan['route']) - len(plan['completed'])} 個")
+    else:
         col1.metric("体験施設数", f"{len(selected_attrs)} 個")
-        col2.metric("総待ち時間（目安）", f"{total_w} 分")
-        col3.metric("全日程終了予定", end_time_str)
+    col2.metric("総待ち時間（目安）", f"{total_w} 分")
+    col3.metric("全日程終了予定", end_time_str)
 
-        st.divider()
-        t_tab, m_tab = st.tabs(["📋 本日のプラン", "🗺️ マップで確認"])
-        
+    st.divider()
+    # 開いているタブだけを描画する (地図は開かれるまで plotly も読み込まない)
+    t_tab, m_tab = st.tabs(["📋 本日のプラン", "🗺️ マップで確認"], key="result_tab", on_change="rerun")
+    
+    if t_tab.open:
         with t_tab:
-            for item in timeline:
-                # 時間フォーマット
-                a_h, a_m = item['arrive'] // 60, item['arrive'] % 60
-                s_h, s_m = item['start'] // 60, item['start'] % 60
-                e_h, e_m = item['end'] // 60, item['end'] % 60
-                
-                badge = ""
-                border_color = "#AAAAAA"
-                if item['area'] in AREA_INFO and item['area'] != "NA":
-                    bg_color = AREA_INFO[item['area']]['color']
-                    border_color = bg_color
-                    badge = f"<span class='area-badge' style='background:{bg_color};'>{AREA_INFO[item['area']]['name']}</span><br>"
-                
-                icon = "🎪"
-                if item['type'] == 'Travel': icon = "🚶"
-                elif item['type'] == 'Rest': icon = "🍽️"
-                
-                wait_text = f"<span class='wait-time'>待ち時間: {item['wait']}分</span> | " if item['wait'] > 0 else ""
-                
-                st.markdown(f"""
-                <div class='app-card' style='border-left-color: {border_color};'>
-                    {badge}
-                    <span class='time-text'>{a_h:02d}:{a_m:02d}</span>
-                    <span style='font-size:1.1em; font-weight:700;'>{icon} {item['name']}</span>
-                    <div style='color:#666666; font-size:0.9em; margin-top:8px; padding-left:70px;'>
-                        {wait_text}体験開始: {s_h:02d}:{s_m:02d} ～ 終了: {e_h:02d}:{e_m:02d} ({item['dur']}分)
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
+            # カードは1回の markdown にまとめて送る
+            st.markdown("".join(_timeline_card(item) for item in timeline), unsafe_allow_html=True)
 
+    if m_tab.open:
         with m_tab:
             st.image("https://upload.wikimedia.org/wikipedia/commons/a/a2/Tokyo_DisneySea_overview.jpg", caption="パーク全体マップ（参考）")
-            
-            map_pts = [{"x": 0, "y": 0, "name": "エントランス", "area": "エントランス", "color": "#AAAAAA"}]
-            for i in timeline:
-                if i['type'] == 'Ride' and i['name'] in MASTER_DB:
-                    data = MASTER_DB[i['name']]
-                    map_pts.append({"x": data['pos'][0], "y": data['pos'][1], "name": i['name'], 
-                                    "area": AREA_INFO[data['area']]['name'], "color": AREA_INFO[data['area']]['color']})
-            
-            df_map = pd.DataFrame(map_pts)
-            fig_map = px.scatter(df_map, x='x', y='y', text='name', color='area',
-                                color_discrete_map={row['area']: row['color'] for _, row in df_map.iterrows()})
-            
-            fig_map.add_trace(go.Scatter(x=df_map['x'], y=df_map['y'], mode='lines', 
-                                         line=dict(color='#1F3C88', width=2, dash='dot'), showlegend=False))
-            fig_map.update_traces(marker=dict(size=14, line=dict(width=1, color='#FFFFFF')), textposition='top center')
-            fig_map.update_layout(
-                paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='#F8F9FA', font_color='#333333',
-                xaxis=dict(visible=False), yaxis=dict(visible=False), 
-                title=dict(text="本日の移動ルート", font=dict(color="#1F3C88", size=18, family="M PLUS 1p")),
-                height=600, margin=dict(l=0, r=0, t=50, b=0)
-            )
-            st.plotly_chart(fig_map, use_container_width=True)
+            ride_ids = tuple(CATALOG.name_to_id[i['name']] for i in timeline if i['type'] == 'Ride')
+            st.plotly_chart(_route_map_figure((plan['start_id'],) + ride_ids), use_container_width=True)
+
+    diag_box = st.expander("🔧 診断情報", key="diag_open", on_change="rerun")
+    if diag_box.open:
+        with diag_box:
+            import pandas as pd
+            diag = stats.to_dict()
+            st.caption(f"ソルバー: {diag['info'].get('solver', '-')}")
+            col_c, col_t = st.columns(2)
+            col_c.dataframe(pd.DataFrame(list(diag['counters'].items()), columns=["カウンタ", "値"]), hide_index=True)
+            col_t.dataframe(pd.DataFrame([(name, t['calls'], round(t['seconds'] * 1000, 2)) for name, t in diag['timers'].items()],
+                                         columns=["タイマー", "回数", "合計(ms)"]), hide_index=True)
+            if len(diag['trace']) > 1:
+                st.line_chart(pd.DataFrame(diag['trace'], columns=["反復", "現在解", "最良解"]).set_index("反復"))
+            col_j, col_p = st.columns(2)
+            col_j.download_button("JSON で保存", stats.to_json(), file_name="plan_stats.json", mime="application/json")
+            col_p.download_button("Prometheus 形式で保存", stats.to_prometheus(), file_name="plan_stats.prom", mime="text/plain")
+
+# ==========================================
+# 5. ヘッドレス一括プランニング (JSONL 入出力)
+# ==========================================
+BATCH_TIME_BUDGET_MS = 100  # 一括処理では1件あたりこの時間で anneal_timed を回す
+BATCH_MAX_TIME_BUDGET_MS = 10000  # リクエストごとに指定できる探索時間の上限
+
+def _fmt_minutes(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def read_plan_requests(lines):
+    """JSONL の各行を (行番号, リクエスト) にして順に返す。空行は飛ばし、壊れた行はエラーとして渡す"""
+    for line_no, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_no, ValueError(f"invalid JSON: {e}")
+
+def plan_request(line_no, request, time_budget_ms=BATCH_TIME_BUDGET_MS):
+    """プランリクエスト1件を解いて結果の dict を返す。
+
+    request のキー: date (YYYY-MM-DD), rain_prob, holiday, entry_time (HH:MM),
+    selections, dpa, auto_rest, 任意で id / seed / time_budget_ms / diagnostics (true なら計測値を stats に付ける)
+    """
+    request_id = request.get("id", line_no) if isinstance(request, dict) else line_no
+    try:
+        if isinstance(request, Exception):
+            raise request
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+        env_args = (date.fromisoformat(request["date"]), int(request.get("rain_prob", 0)), bool(request.get("holiday", False)))
+        entry = datetime.strptime(request.get("entry_time", "08:30"), "%H:%M")
+        start_time = entry.hour * 60 + entry.minute
+        selections, dpa = request["selections"], request.get("dpa", [])
+        if not isinstance(selections, list) or not isinstance(dpa, list):
+            raise ValueError("selections and dpa must be lists")
+        if not selections:
+            raise ValueError("selections is empty")
+        unknown = [name for name in selections + dpa if name not in CATALOG.name_to_id]
+        if unknown:
+            raise ValueError(f"unknown attraction: {', '.join(map(str, unknown))}")
+        duplicated = sorted({name for name in selections if selections.count(name) > 1})
+        if duplicated:
+            raise ValueError(f"duplicated selection: {', '.join(duplicated)}")
+        # UI と同じく、DPA は選んだ施設のうち DPA 対象のものにしか付けられない
+        invalid_dpa = [name for name in dpa if name not in selections or not CATALOG.dpa[CATALOG.name_to_id[name]]]
+        if invalid_dpa:
+            raise ValueError(f"dpa must be selected DPA attractions: {', '.join(invalid_dpa)}")
+        selected = CATALOG.encode(selections)
+        dpa_ids = CATALOG.encode(list(dict.fromkeys(dpa)))
+        auto_rest = bool(request.get("auto_rest", True))
+        # null や bool を素通しすると time_budget_ms=None でワーカー内に anneal_parallel のプールが入れ子になる
+        budget = request.get("time_budget_ms", time_budget_ms)
+        if isinstance(budget, bool) or not isinstance(budget, (int, float)) or not 0 < budget <= BATCH_MAX_TIME_BUDGET_MS:
+            raise ValueError(f"time_budget_ms must be a number in (0, {BATCH_MAX_TIME_BUDGET_MS}]")
+        seed = request.get("seed", 0)
+        if isinstance(seed, bool) or not isinstance(seed, int):
+            raise ValueError("seed must be an integer")
+    except (KeyError, ValueError, TypeError) as e:
+        message = f"missing field: {e}" if isinstance(e, KeyError) else str(e)
+        return {"id": request_id, "line": line_no, "status": "error", "error": message}
+
+    try:
+        # 同じ環境のリクエストは待ち時間テーブルと移動時間マトリクスをワーカー内で使い回す
+        core = _worker_core(env_args, FS_TRAVEL_SEED)
+        stats = PlanStats() if request.get("diagnostics") else None
+        route = core.plan(selected, dpa_ids, auto_rest, start_time, seed=seed, time_budget_ms=budget, stats=stats)
+        total_w, end_t, timeline = core.calc_route_cost(route, start_time, dpa_ids, auto_rest)
+    except Exception as e:
+        # 1件の失敗でバッチ全体 (プール) を止めない
+        return {"id": request_id, "line": line_no, "status": "error", "error": f"planning failed: {type(e).__name__}: {e}"}
+    feasible = total_w != INF and end_t <= PARK_CLOSING_MINUTES
+    result = {
+        "id": request_id, "line": line_no, "status": "ok" if feasible else "infeasible",
+        "route": CATALOG.decode(route),
+        "total_wait": total_w if feasible else None,
+        "end_time": _fmt_minutes(end_t),
+        "timeline": [{"name": item['name'], "type": item['type'], "arrive": _fmt_minutes(item['arrive']),
+                      "start": _fmt_minutes(item['start']), "end": _fmt_minutes(item['end']), "wait": item['wait']}
+                     for item in timeline],
+    }
+    if stats is not None:
+        result["stats"] = stats.to_dict()
+    return result
+
+def plan_batch(requests, workers=None, max_inflight=None, time_budget_ms=BATCH_TIME_BUDGET_MS):
+    """(行番号, リクエスト) の列をプロセスプールで解き、終わった順に結果を返すジェネレータ。
+
+    同時に抱えるリクエストは max_inflight 件 (既定: ワーカー数 x 4) までに抑えるので、
+    入力がどれだけ大きくてもメモリ使用量は一定。
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for line_no, request in requests:
+            yield plan_request(line_no, request, time_budget_ms)
+        return
+    max_inflight = max_inflight or workers * 4
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for line_no, request in requests:
+            if len(pending) >= max_inflight:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(pool.submit(plan_request, line_no, request, time_budget_ms))
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+def batch_main(argv=None):
+    parser = argparse.ArgumentParser(prog="map-route.py batch", description="JSONL のプランリクエストを一括で解く")
+    parser.add_argument("input", help="入力 JSONL ('-' で標準入力)")
+    parser.add_argument("-o", "--output", default="-", help="出力 JSONL ('-' で標準出力)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="ワーカープロセス数 (既定: CPUコア数)")
+    parser.add_argument("--budget-ms", type=int, default=BATCH_TIME_BUDGET_MS, help="1件あたりの探索時間 (ミリ秒)")
+    args = parser.parse_args(argv)
+
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    dst = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    counts = {"ok": 0, "infeasible": 0, "error": 0}
+    try:
+        for result in plan_batch(read_plan_requests(src), args.workers, time_budget_ms=args.budget_ms):
+            dst.write(json.dumps(result, ensure_ascii=False) + "\n")
+            dst.flush()
+            counts[result['status']] += 1
+    finally:
+        if src is not sys.stdin: src.close()
+        if dst is not sys.stdout: dst.close()
+    print(f"ok={counts['ok']} infeasible={counts['infeasible']} error={counts['error']}", file=sys.stderr)
+    return 1 if counts['error'] else 0
 
 if __name__ == "__main__":
+    # `python map-route.py batch ...` はヘッドレス実行、それ以外 (streamlit run) は UI
+    if sys.argv[1:2] == ["batch"]:
+        sys.exit(batch_main(sys.argv[2:]))
     main()
\ No newline at end of file